@@ -18,6 +18,9 @@ from pandas import DataFrame as df
 from yaml import safe_load
 
 
+# marks parameters that have no default value in workflow.get_param
+no_default = object()
+
 
 
 
@@ -115,12 +118,17 @@ class workflow(object):
     
     
     
-    def get_param(self, act, param):
+    def get_param(self, act, param, default=no_default):
         '''
-        Fetches a parameter value from the self.params DataFrame.
+        Fetches a parameter value from the self.params DataFrame. If the
+        parameter is not in the file and a default value is given, the 
+        default is returned.
         '''
         par_seg = self.params[self.params['operation']==act]
-        return par_seg[par_seg['param']==param]['value'].iloc[0]
+        value = par_seg[par_seg['param']==param]['value']
+        if len(value)==0 and default is not no_default:
+            return default
+        return value.iloc[0]
     
     
     
@@ -197,6 +205,14 @@ class workflow(object):
         cal_image = self.get_param('calibration', 'calibration_image')
         res = self.get_param('calibration', 'resolution').split(',')
         res = (float(res[0]), float(res[1]))
+        solver = self.get_param('calibration', 'solver', 
+                                default='nelder-mead')
+        fine_solver = self.get_param('calibration', 'fine_solver', 
+                                     default=solver)
+        correction_order = self.get_param('calibration', 'correction_order',
+                                          default=None)
+        regularization = self.get_param('calibration', 'regularization', 
+                                        default=0.0)
         
         
         # checking that a camera file in the working directory
@@ -208,6 +224,14 @@ class workflow(object):
             cam = camera(cam_name, res, cal_points_fname = blob_file)
             cam.load('.')
             print('camera data loaded successfully.')
+            
+            # the order of the loaded camera is kept unless the parameters
+            # file asks for a different one
+            order = cam.get_correction_order()
+            if correction_order is not None and correction_order != order:
+                print('changing the correction order from %d to %d.'%(
+                      order, correction_order))
+                cam.set_correction_order(correction_order)
             cal = calibrate(cam, cam.lab_points, cam.image_points)
             print('initial error: %.3f pixels'%(cal.mean_squared_err()))
             print('')
@@ -225,13 +249,14 @@ class workflow(object):
                 
                 if user == '1':
                     print('\n', 'Iterating to minimize external parameters')
-                    cal.searchCalibration(maxiter=2000)
+                    cal.searchCalibration(maxiter=2000, method=solver)
                     err = cal.mean_squared_err()
                     print('\n','calibration error: %.3f pixels'%(err),'\n')
                 
                 if user == '2':
                     print('\n', 'Iterating to minimize correction terms')
-                    cal.fineCalibration()
+                    cal.fineCalibration(method=fine_solver, 
+                                        regularization=regularization)
                     err = cal.mean_squared_err()
                     print('\n','calibration error:', err,'\n')
                     
@@ -272,7 +297,9 @@ class workflow(object):
         '''
         from myptv.segmentation_mod import loop_segmentation
         from myptv.segmentation_mod import particle_segmentation
-        from numpy import zeros
+        from myptv.segmentation_mod import image_folder, tiff_image_stack
+        from myptv.segmentation_mod import temporal_background
+        from myptv.segmentation_mod import multi_camera_segmentation
         from skimage.io import imread
         import os
         
@@ -293,49 +320,121 @@ class workflow(object):
         plot_res = self.get_param('segmentation', 'plot_result')
         save_name = self.get_param('segmentation', 'save_name')
         ROI = self.get_param('segmentation', 'ROI')
+        n_workers = self.get_param('segmentation', 'n_workers', default=1)
+        tile_size = self.get_param('segmentation', 'tile_size', default=None)
+        n_threads = self.get_param('segmentation', 'n_threads', default=1)
+        prefetch = self.get_param('segmentation', 'prefetch', default=2)
+        precision = self.get_param('segmentation', 'precision', 
+                                   default='float32')
+        resume = self.get_param('segmentation', 'resume', default=False)
+        bg_method = self.get_param('segmentation', 'background', 
+                                   default=None)
+        bg_samples = self.get_param('segmentation', 'background_samples', 
+                                    default=50)
+        bg_cache_dir = self.get_param('segmentation', 'background_cache_dir',
+                                      default=None)
         
         
         # reading preprepared mask
         if type(mask)==str:
             mask = imread(mask)
         
-        # get the shape of the images
-        allfiles = os.listdir(dirname)
-        n_ext = len(ext)
-        image_files = sorted(list(filter(lambda s: s[-n_ext:]==ext, allfiles)))
-        image0 = imread(os.path.join(dirname,image_files[0]))
+        # several cameras can be segmented in one pass by giving comma 
+        # separated lists of image folders and save names
+        dirnames = [val.strip() for val in dirname.split(',')]
+        if save_name is None:
+            save_names = [None for d in dirnames]
+        else:
+            save_names = [val.strip() for val in save_name.split(',')]
+        dirname, save_name = dirnames[0], save_names[0]
+        
+        # the images are either files in a folder or pages of a multi-page
+        # TIFF file
+        sources = []
+        for d in dirnames:
+            if os.path.isfile(d):
+                sources.append(tiff_image_stack(d))
+            else:
+                sources.append(image_folder(d, ext))
+        source = sources[0]
         
-        # preparing a mask using the given ROI
+        # get the shape of the images
+        image0 = source[0]
+        
+        # calculating (or loading the cached) static background; it is 
+        # cached in the given folder, or else next to the results
+        if bg_cache_dir is None and save_name is not None:
+            bg_cache_dir = os.path.dirname(os.path.abspath(save_name))
+        backgrounds = []
+        for src in sources:
+            if bg_method is not None:
+                print('calculating the background (%s).'%bg_method)
+                tb = temporal_background(src, method=bg_method, 
+                                         N_samples=bg_samples, 
+                                         cache_dir=bg_cache_dir)
+                backgrounds.append(tb.get_background())
+            else:
+                backgrounds.append(None)
+        background = backgrounds[0]
+        
+        # the images are cropped to the ROI before the segmentation
         if ROI is not None:
             ROI = [int(val) for val in ROI.split(',')]
-            mask_ROI = zeros(image0.shape)
-            mask_ROI[ROI[2]:ROI[3]+1, ROI[0]:ROI[1]+1] = 1
-            mask = mask * mask_ROI
         
         
         # segmenting the image if there are more than 1 frames
         if N_img is None or N_img>1:
-            loopSegment = loop_segmentation(dirname, 
-                                            extension=ext,
-                                            N_img=N_img, 
-                                            sigma=sigma, 
-                                            threshold=threshold, 
-                                            local_filter=local_filter, 
-                                            max_xsize=max_xsize, 
-                                            max_ysize=max_ysize,
-                                            max_area=max_area,
-                                            min_xsize=min_xsize, 
-                                            min_ysize=min_ysize,
-                                            min_area=min_area,
-                                            mask=mask)
-        
-            loopSegment.segment_folder_images()
+            segmentations = []
+            for src, bg in zip(sources, backgrounds):
+                loopSegment = loop_segmentation(src, 
+                                                extension=ext,
+                                                N_img=N_img, 
+                                                sigma=sigma, 
+                                                threshold=threshold, 
+                                                local_filter=local_filter, 
+                                                max_xsize=max_xsize, 
+                                                max_ysize=max_ysize,
+                                                max_area=max_area,
+                                                min_xsize=min_xsize, 
+                                                min_ysize=min_ysize,
+                                                min_area=min_area,
+                                                mask=mask,
+                                                n_workers=n_workers,
+                                                background=bg,
+                                                ROI=ROI,
+                                                tile_size=tile_size,
+                                                n_threads=n_threads,
+                                                prefetch=prefetch,
+                                                precision=precision)
+                segmentations.append(loopSegment)
+        
+            # the blobs are written to the file frame by frame
+            if len(segmentations) == 1:
+                loopSegment.segment_folder_images(stream_fname=save_name,
+                                                  resume=resume)
+                timing = loopSegment.timing
+            else:
+                multiSegment = multi_camera_segmentation(segmentations, 
+                                                     save_names=save_names,
+                                                     n_workers=n_workers,
+                                                     prefetch=prefetch)
+                multiSegment.segment_images(resume=resume)
+                timing = multiSegment.timing
             
-            print('\n','blobs found:', len(loopSegment.blobs))
+            for d, fname, loopSegment in zip(dirnames, save_names, 
+                                             segmentations):
+                print('\n', d, '- blobs found:', loopSegment.N_blobs)
+                for crit, counts in loopSegment.rejected.items():
+                    if counts.sum() > 0:
+                        print(' rejected by %s: %d'%(crit, counts.sum()))
             
-            if save_name is not None:
-                loopSegment.save_results(save_name)
-                print('File saved (%s).'%(save_name))
+                if fname is not None:
+                    print('File saved (%s).'%(fname))
+            
+            print('\n', 'time reading images: %.2f s'%timing['read'])
+            print(' time waiting for images: %.2f s'%timing['io_wait'])
+            print(' time segmenting images: %.2f s'%timing['compute'])
+            print(' total time: %.2f s'%timing['total'])
             
             print('Done.')
         
@@ -343,7 +442,10 @@ class workflow(object):
         # segmenting the image if is only 1 frames
         if N_img == 1:
             print('starting segmentation on a single image.')
-            print(os.path.join(dirname,image_files[0]))
+            if type(source) == image_folder:
+                print(os.path.join(dirname, source.image_files[0]))
+            else:
+                print(dirname)
             particleSegment = particle_segmentation(image0, 
                                                     sigma=sigma, 
                                                     threshold=threshold, 
@@ -354,7 +456,12 @@ class workflow(object):
                                                     min_xsize=min_xsize, 
                                                     min_ysize=min_ysize,
                                                     min_area=min_area,
-                                                    mask=mask)
+                                                    mask=mask,
+                                                    background=background,
+                                                    ROI=ROI,
+                                                    tile_size=tile_size,
+                                                    n_threads=n_threads,
+                                                    precision=precision)
             particleSegment.get_blobs()
             particleSegment.apply_blobs_size_filter()
             
@@ -395,17 +502,26 @@ class workflow(object):
         max_err = self.get_param('matching', 'max_err')
         N_frames = self.get_param('matching', 'N_frames')
         save_name = self.get_param('matching', 'save_name')
+        cameras_file = self.get_param('matching', 'cameras_file', 
+                                      default=None)
+        epipolar_band = self.get_param('matching', 'epipolar_band', 
+                                       default=None)
         
         
         
-        # setting up the img_system 
-        cams = [camera(cn, res) for cn in cam_names]
-        for cam in cams:
-            try:
-                cam.load('')
-            except:
-                raise ValueError('camera file %s not found'%cam.name)
-        imsys = img_system(cams)
+        # setting up the img_system, either from a single cameras file or
+        # from the files of the individual cameras
+        if cameras_file is not None:
+            imsys = img_system(cameras_file)
+            cams = imsys.cameras
+        else:
+            cams = [camera(cn, res) for cn in cam_names]
+            for cam in cams:
+                try:
+                    cam.load('')
+                except:
+                    raise ValueError('camera file %s not found'%cam.name)
+            imsys = img_system(cams)
         
         
         mbf = match_blob_files(blob_fn, 
@@ -414,7 +530,8 @@ class workflow(object):
                                voxel_size, 
                                max_blob_distance,
                                max_err=max_err, 
-                               reverse_eta_zeta=True)
+                               reverse_eta_zeta=True,
+                               epipolar_band=epipolar_band)
         
         # setting the frame range to match
         if N_frames is None:
@@ -9,7 +9,7 @@ calibration module for the cameras
 
 """
 
-from numpy import mean, sum, hstack, array
+from numpy import mean, sum, hstack, array, zeros
 
 
 
@@ -28,6 +28,10 @@ class calibrate(object):
         self.camera = camera
         self.img_coords = img_coords
         self.lab_coords = lab_coords
+        
+        # the coordinates as arrays, for the batched projections
+        self.img_array = array(img_coords, dtype=float)
+        self.lab_array = array(lab_coords, dtype=float)
         self.D_lst = [self.mean_squared_err()]
         self.sep = sum((array(self.img_coords[1])-array(self.img_coords[0]))**2)**0.5
         
@@ -38,23 +42,115 @@ class calibrate(object):
         projection and the given coordinates  (in units of pixel).
         
         (in the calibration we want to minimize this D)
+        
+        All the points are projected at once, with the rotation matrix 
+        of the camera's last calc_R().
         '''
-        z_lst = []        
-        for x in self.lab_coords:
-            z_lst.append(self.camera.projection(x, correction=correction))
-        e = array(z_lst) - array(self.img_coords)
+        z = self.camera.projection(self.lab_array, correction=correction)
+        e = z - self.img_array
         D = mean( sum(e**2, axis=1)**0.5 )
         return D
+    
+    
+    def get_residuals(self, correction=True):
+        '''
+        Returns the differences between the projections of the lab points 
+        and the image coordinates as a vector, 
+        [d_eta_0, d_zeta_0, d_eta_1, d_zeta_1, ...], in pixels.
+        '''
+        z = self.camera.projection(self.lab_array, correction=correction)
+        return (z - self.img_array).ravel()
+    
+    
+    def get_jacobian(self, func, X, f0=None, rel_step=1e-7, typical=None):
+        '''
+        A forward difference Jacobian of a residuals function. Each column 
+        takes one evaluation of func, which projects all the points at once.
+        
+        input - 
+        func - a function of the parameters vector that returns residuals
+        X (array) - the parameters at which the Jacobian is calculated
+        f0 (array) - func(X), if it is known
+        rel_step - the step of each parameter, relative to its magnitude
+        typical (array) - None, or the typical magnitude of each parameter;
+                          the step of a parameter is relative to the 
+                          larger of its magnitude and its typical 
+                          magnitude (1 if typical is None)
         
+        output - 
+        J (array) - the Jacobian with shape (len(f0), len(X))
+        '''
+        from numpy import empty, maximum, abs as npabs
+        X = array(X, dtype=float)
+        if f0 is None:
+            f0 = func(X)
+        if typical is None:
+            typical = 1.0
+        h = rel_step * maximum(typical, npabs(X))
+        J = empty((len(f0), len(X)))
+        for k in range(len(X)):
+            X_ = X.copy()
+            X_[k] += h[k]
+            J[:,k] = (func(X_) - f0) / h[k]
+        func(X)
+        return J
+    
     
-    def searchCalibration(self, maxiter=5000, fix_f=True):
+    def solve_least_squares(self, set_params, X0, maxiter, typical=None):
+        '''
+        Minimizes the residuals vector with scipy's least_squares, using the
+        Jacobian of get_jacobian, and reports the number of iterations and 
+        the time it took.
+        
+        input - 
+        set_params - a function that sets the camera parameters from a 
+                     parameters vector
+        X0 (array) - the initial parameters
+        maxiter - the maximum number of residuals evaluations
+        typical (array) - None, or the typical magnitude of each parameter,
+                          which sets the finite difference steps (see 
+                          get_jacobian)
+        
+        output - the result of least_squares, with the run time (seconds)
+                 added in its attribute time
+        '''
+        from scipy.optimize import least_squares
+        from time import perf_counter
+        
+        def func(X):
+            set_params(X)
+            return self.get_residuals()
+        
+        def jac(X):
+            return self.get_jacobian(func, X, typical=typical)
+        
+        t0 = perf_counter()
+        res = least_squares(func, X0, jac=jac, x_scale='jac', 
+                            max_nfev=maxiter)
+        set_params(res.x)
+        res.time = perf_counter() - t0
+        
+        self.D_lst.append(self.mean_squared_err())
+        print('least squares: %d iterations, %d evaluations, %.3f seconds'%(
+              res.njev, res.nfev, res.time))
+        print(res.message)
+        return res
+        
+    
+    def searchCalibration(self, maxiter=5000, fix_f=True, 
+                          method='nelder-mead'):
         '''
         using scipy's minimize function to obtain calibration
         parameters for the camera.
+        
+        If method is 'least_squares', the residuals vector is minimized 
+        with scipy's least_squares instead of minimizing the mean error 
+        with the Nelder-Mead method; this usually converges in tens of 
+        iterations. maxiter is then the maximum number of evaluations.
         '''
         from scipy.optimize import minimize
         
-        def func(X):
+        def set_params(X):
             self.camera.O = X[:3]
             self.camera.theta = X[3:6]
             self.camera.xh = X[6]
@@ -64,7 +160,9 @@ class calibrate(object):
                 self.camera.f = X[-1]
                 
             self.camera.calc_R()
-            
+        
+        def func(X):
+            set_params(X)
             meanSquaredErr = self.mean_squared_err()
             self.D_lst.append( meanSquaredErr )
             return meanSquaredErr
@@ -76,6 +174,9 @@ class calibrate(object):
         
         else:
             X0 = hstack([c.O, c.theta, c.xh, c.yh, c.f])
+        
+        if method == 'least_squares':
+            return self.solve_least_squares(set_params, X0, maxiter)
                         
         res = minimize(func, X0, method='nelder-mead', 
                        options={'disp': True, 'maxiter': maxiter})
@@ -83,31 +184,118 @@ class calibrate(object):
     
     
     
-    def fineCalibration(self, maxiter=500):
+    def fineCalibration(self, maxiter=500, method='nelder-mead', 
+                        regularization=0.0):
         '''
         Calibration for the nonlinear error term. 
         This function attempts to find the 27 parameters that minimize the
         calibration error using scipy.minimize.
+        
+        If method is 'least_squares', the residuals vector is minimized 
+        with scipy's least_squares instead (see searchCalibration). If 
+        method is 'linear', the coefficients are found in closed form with 
+        linearCorrectionCalibration, using the given regularization.
         '''
         from scipy.optimize import minimize
         
-        def func(X):
-            shape = (2, self.camera.E.shape[1])
-            X_ = X.reshape(shape)
+        if method == 'linear':
+            return self.linearCorrectionCalibration(regularization)
+        
+        def set_params(X):
+            X_ = X.reshape((2, self.camera.E.shape[1]))
             self.camera.E[0,:] = X_[0,:]
             self.camera.E[1,:] = X_[1,:]
+        
+        def func(X):
+            set_params(X)
             meanSquaredErr = self.mean_squared_err(correction=True)
             self.D_lst.append( meanSquaredErr )
             return meanSquaredErr
         
         c = self.camera
-        X0 = c.E[:2,:]
+        X0 = c.E[:2,:].ravel()
+        
+        if method == 'least_squares':
+            # the terms of Z3 span many orders of magnitude (the cubic ones
+            # are ~1e9 px^3), so a coefficient is changed by a step that 
+            # moves the projections by a small fraction of a pixel
+            typical = 1.0 / self.get_Z3_scale()
+            typical = hstack([typical, typical])
+            return self.solve_least_squares(set_params, X0, maxiter, 
+                                            typical=typical)
+        
         res = minimize(func, X0, method='nelder-mead', 
                        options={'disp': True, 'maxiter': maxiter})
         return res
     
     
     
+    def get_Z3_scale(self):
+        '''
+        Returns the RMS of each of the correction terms (Z3) over the image
+        coordinates of the calibration points, i.e. the typical change of 
+        the projections due to a unit change of each coefficient in E. 
+        Terms that vanish at all the points get a scale of 1.
+        '''
+        from numpy import column_stack
+        eta, zeta = self.img_array[:,0], self.img_array[:,1]
+        Z = column_stack(self.camera.get_Z3(eta, zeta))
+        scale = mean(Z**2, axis=0)**0.5
+        scale[scale == 0] = 1.0
+        return scale
+    
+    
+    
+    def linearCorrectionCalibration(self, regularization=0.0):
+        '''
+        Finds the coefficients of the correction terms, E[0] and E[1], in
+        closed form for the current external parameters.
+        
+        The correction is linear in E: if a lab point is projected by the
+        pinhole model (without the correction) onto (eta_p, zeta_p), and its
+        image coordinates are (eta, zeta), then 
+            eta_p - eta = E[0] * Z3(eta, zeta)
+            zeta_p - zeta = E[1] * Z3(eta, zeta)
+        so E[0] and E[1] are the solutions of one linear least squares 
+        problem. This works the same for the quadratic and the cubic terms
+        (see camera.set_correction_order).
+        
+        input - 
+        regularization - a ridge (Tikhonov) term that pulls the 
+                         coefficients towards zero; it is applied to the 
+                         polynomial terms after they are scaled to unit 
+                         RMS, so it is dimensionless. 0 means no 
+                         regularization.
+        
+        output - 
+        E (array, 2 x number of terms) - the new E[0] and E[1]
+        '''
+        from numpy import column_stack, eye, dot
+        from numpy.linalg import lstsq, solve
+        
+        eta, zeta = self.img_array[:,0], self.img_array[:,1]
+        Z = column_stack(self.camera.get_Z3(eta, zeta))
+        z_p = self.camera.projection(self.lab_array, correction=False)
+        d = z_p - self.img_array
+        
+        # scale the terms, which span many orders of magnitude
+        scale = self.get_Z3_scale()
+        Zs = Z / scale
+        
+        if regularization > 0:
+            A = dot(Zs.T, Zs) + regularization * eye(Zs.shape[1])
+            E = solve(A, dot(Zs.T, d))
+        else:
+            E = lstsq(Zs, d, rcond=None)[0]
+        E = (E / scale[:,None]).T
+        
+        self.camera.E[0,:] = E[0]
+        self.camera.E[1,:] = E[1]
+        self.D_lst.append(self.mean_squared_err())
+        return E
+    
+    
+    
     def plot_proj(self, ax = None):
         import matplotlib.pyplot as plt
         
@@ -119,7 +307,7 @@ class calibrate(object):
         for i in range(imc.shape[0]):
             ax.text(imc[i,0], imc[i,1], '%d'%i, color = 'b')
         
-        z_lst = array([self.camera.projection(x) for x in self.lab_coords])
+        z_lst = self.camera.projection(self.lab_array)
         ax.plot( z_lst[:,0], z_lst[:,1], 'xr' )
         for i in range(z_lst.shape[0]):
             ax.text(z_lst[i,0], z_lst[i,1], '%d'%i, color = 'r')
@@ -189,4 +377,199 @@ class calibrate(object):
         
         
         
-        
\ No newline at end of file
+        
+
+
+
+class bundle_adjustment(object):
+    '''
+    A joint calibration of all the cameras of an img_system. The external
+    parameters of all the cameras (O, theta, xh, yh, and optionally f) are
+    found together by minimizing the reprojection errors of the calibration
+    points of each camera and, optionally, of particles that were matched 
+    in several cameras. The positions of these particles are unknowns of 
+    the problem too, so the calibration also makes the cameras consistent 
+    with each other.
+    
+    Each residual depends only on the parameters of one camera and of at 
+    most one particle, so the Jacobian is block-sparse; its structure is 
+    given to scipy's least_squares (jac_sparsity), which makes the cost of 
+    the finite difference Jacobian scale with the number of points rather 
+    than with the number of points times the number of parameters.
+    
+    Calibration points are required: with particles alone, a rotation, 
+    translation and scaling of all the cameras and particles together 
+    leaves the residuals unchanged, so the solution would be arbitrary.
+    
+    The correction terms (E) of the cameras are not changed.
+    '''
+    
+    def __init__(self, img_system, cal_points, particles=None, fix_f=True):
+        '''
+        input - 
+        img_system - an instance of img_system with the cameras
+        cal_points - a list with an item for each camera, that is either 
+                     None or a tuple (lab_coords, img_coords) with the lab
+                     space and image space coordinates of the camera's 
+                     calibration points
+        particles - None, or a list of matched particles in the format of 
+                    match_blob_files.particles, i.e. 
+                    [x, y, z, [(camera, (blob number, (eta, zeta))), ...], 
+                     ...]. Particles seen by less than two cameras are 
+                    ignored.
+        fix_f - if False, the focal lengths are calibrated too
+        '''
+        self.imsys = img_system
+        self.cameras = img_system.cameras
+        self.fix_f = fix_f
+        self.n_cam_params = 8 if fix_f else 9
+        n_cams = len(self.cameras)
+        
+        # the calibration points of each camera
+        self.lab, self.img = [], []
+        for c in range(n_cams):
+            if cal_points is None or cal_points[c] is None:
+                self.lab.append(zeros((0, 3)))
+                self.img.append(zeros((0, 2)))
+            else:
+                self.lab.append(array(cal_points[c][0], dtype=float))
+                self.img.append(array(cal_points[c][1], dtype=float))
+        
+        # the calibration points fix the lab coordinate system (the gauge)
+        if sum([len(lab) for lab in self.lab]) == 0:
+            raise ValueError('bundle adjustment needs calibration points.')
+        
+        # the particle observations of each camera
+        if particles is None:
+            particles = []
+        particles = [p for p in particles if len(p[3]) >= 2]
+        self.X0 = array([p[:3] for p in particles], dtype=float)
+        self.X0 = self.X0.reshape(-1, 3)
+        self.obs_particle = [[] for c in range(n_cams)]
+        self.obs_img = [[] for c in range(n_cams)]
+        for k, p in enumerate(particles):
+            for c, (bn, xy) in p[3]:
+                self.obs_particle[c].append(k)
+                self.obs_img[c].append(xy)
+        self.obs_particle = [array(o, dtype=int) for o in self.obs_particle]
+        self.obs_img = [array(o, dtype=float).reshape(-1, 2) 
+                        for o in self.obs_img]
+        
+        
+    def get_parameters(self):
+        '''Returns the vector of the unknowns: the parameters of each 
+        camera followed by the positions of the particles.'''
+        X = []
+        for cam in self.cameras:
+            X += [cam.O, cam.theta, [cam.xh, cam.yh]]
+            if not self.fix_f:
+                X.append([cam.f])
+        X.append(self.X0.ravel())
+        return hstack(X)
+    
+    
+    def set_parameters(self, X):
+        '''Sets the camera parameters from the vector of unknowns, and
+        returns the positions of the particles. The values are copied, so 
+        the cameras do not share memory with the vector.'''
+        n = self.n_cam_params
+        for c, cam in enumerate(self.cameras):
+            P = X[c*n:(c+1)*n]
+            cam.O = P[:3].copy()
+            cam.theta = P[3:6].copy()
+            cam.xh, cam.yh = float(P[6]), float(P[7])
+            if not self.fix_f:
+                cam.f = float(P[8])
+            cam.calc_R()
+        return X[len(self.cameras)*n:].reshape(-1, 3).copy()
+    
+    
+    def get_residuals(self, X):
+        '''
+        Returns the residuals vector for a vector of unknowns; for each
+        camera, the reprojection errors of its calibration points and then
+        of its particle observations, in pixels.
+        '''
+        from numpy import concatenate, vstack
+        particles_X = self.set_parameters(X)
+        res = []
+        for c, cam in enumerate(self.cameras):
+            points = vstack([self.lab[c], particles_X[self.obs_particle[c]]])
+            img = vstack([self.img[c], self.obs_img[c]])
+            res.append((cam.projection(points) - img).ravel())
+        return concatenate(res)
+    
+    
+    def get_jacobian_sparsity(self):
+        '''Returns the sparsity structure of the Jacobian, a sparse matrix 
+        with ones where a residual depends on an unknown.'''
+        from scipy.sparse import lil_matrix
+        n = self.n_cam_params
+        n_cams = len(self.cameras)
+        n_res = sum([2*(len(self.lab[c]) + len(self.obs_img[c])) 
+                     for c in range(n_cams)])
+        S = lil_matrix((n_res, n*n_cams + 3*len(self.X0)), dtype=int)
+        
+        i = 0
+        for c in range(n_cams):
+            n_c = 2*(len(self.lab[c]) + len(self.obs_img[c]))
+            S[i:i+n_c, c*n:(c+1)*n] = 1
+            i += 2*len(self.lab[c])
+            for k in self.obs_particle[c]:
+                S[i:i+2, n*n_cams+3*k:n*n_cams+3*k+3] = 1
+                i += 2
+        return S
+    
+    
+    def solve(self, maxiter=1000):
+        '''
+        Runs the joint calibration with scipy's least_squares, and reports 
+        the number of iterations, the time, and the errors of each camera.
+        
+        input - 
+        maxiter - the maximum number of residual evaluations
+        
+        output - the result of least_squares, with the run time (seconds) 
+                 added in its attribute time. The calibrated particle 
+                 positions are kept in self.particles_X.
+        '''
+        from scipy.optimize import least_squares
+        from time import perf_counter
+        
+        t0 = perf_counter()
+        res = least_squares(self.get_residuals, self.get_parameters(), 
+                            jac_sparsity=self.get_jacobian_sparsity(),
+                            x_scale='jac', max_nfev=maxiter)
+        self.particles_X = self.set_parameters(res.x)
+        res.time = perf_counter() - t0
+        
+        print('bundle adjustment: %d iterations, %d evaluations, %.3f seconds'%(
+              res.njev, res.nfev, res.time))
+        print(res.message)
+        for c, cam in enumerate(self.cameras):
+            print('%s: calibration points error %.3f, particles error %.3f'%(
+                  cam.name, *self.get_errors(c)))
+        return res
+    
+    
+    def get_errors(self, c):
+        '''
+        Returns the mean reprojection errors (in pixels) of the calibration
+        points and of the particle observations of camera number c.
+        '''
+        cam = self.cameras[c]
+        errors = []
+        for points, img in [(self.lab[c], self.img[c]), 
+                            (self.get_particles_X()[self.obs_particle[c]], 
+                             self.obs_img[c])]:
+            if len(points) == 0:
+                errors.append(0.0)
+                continue
+            e = cam.projection(points) - img
+            errors.append(mean(sum(e**2, axis=1)**0.5))
+        return errors
+    
+    
+    def get_particles_X(self):
+        '''Returns the current particle positions.'''
+        return getattr(self, 'particles_X', self.X0)
@@ -37,29 +37,58 @@ The correction term is given as a cubic polynomial in eta and zeta as follows:
            Z3 = [eta, zeta, eta^2, zeta^2, eta*zeta, eta^3, eta^2*zeta, zeta^2*eta, zeta^3]  
 
 so Z3 are the polymer terms and [E] is a (3X9) matrix with a total 
-of 27 coefficients.  
+of 27 coefficients. By default only the first five (quadratic) terms are 
+used, and [E] is a (3X5) matrix; the cubic terms are used if [E] has 9 
+columns (see camera.set_correction_order).  
 
 """
 
 import os
-from math import sin, cos
-from numpy import zeros, array, dot
-from numpy.linalg import inv
+from math import sin, cos, sqrt
+from numpy import zeros, array, dot, empty, asarray, ndim, column_stack
+from numpy import sqrt as npsqrt
 from myptv.utils import line_dist
 
 
 
 
 
+# the camera parameters that are stored in the .npz camera files, in the
+# order in which they are stored
+camera_fields = ['O', 'theta', 'f', 'xh', 'yh', 'resolution', 'E']
+
+
+# cameras that were loaded from .npz files; the keys are the paths and the
+# values are (mtime, cameras) of the latest version of each file
+_cameras_cache = {}
+
+
+
+
 class img_system(object):
     '''
     an object that holds a number of cameras.
+    
+    input - 
+    camera_list - either a list of camera objects, or the path of an .npz
+                  file with the cameras (see save_cameras). The cameras
+                  loaded from a file are shared with other img_system 
+                  objects loaded from the same file (see load_cameras).
     '''
     
     def __init__(self, camera_list):
+        if type(camera_list) == str:
+            camera_list = load_cameras(camera_list)
         self.cameras = camera_list
     
     
+    def save(self, fname):
+        '''
+        will save all the cameras in a single .npz file
+        '''
+        save_cameras(self.cameras, fname)
+    
+    
     def stereo_match(self, coords, d_max):
         '''
         given n particle images [(eta, zeta) coords in camera space], this will
@@ -88,15 +117,20 @@ class img_system(object):
         cams = []
         d = []
         keys = list(coords.keys())
+        
+        # the ray of each camera is calculated once
+        r = dict([(k, self.cameras[k].get_r(coords[k][0], coords[k][1])) 
+                  for k in keys])
+        
         for i in range(N):
             for j in range(i+1,N):
                 ki = keys[i]
                 O1 = self.cameras[ki].O
-                r1 = self.cameras[ki].get_r(coords[ki][0], coords[ki][1])
+                r1 = r[ki]
                 
                 kj = keys[j]
                 O2 = self.cameras[kj].O
-                r2 = self.cameras[kj].get_r(coords[kj][0], coords[kj][1])
+                r2 = r[kj]
                 
                 D, x_ij = line_dist(O1, r1, O2, r2)
                 
@@ -185,57 +219,137 @@ class camera(object):
                     [sin(tz),cos(tz),0],
                     [0,0,1]])
         self.R = dot(dot(Rx,Ry), Rz)
+        
+        # the inverse of the rotation matrix is its transpose; it is kept 
+        # here since it is used in every projection
+        self.Rinv = self.R.T.copy()
     
     
     def get_r(self, eta, zeta):
         '''
         r = ([eta, zeta, f] + e) * [R]
         
-        input - pixel coordinates (eta, zeta) seen by the camera
-        output - direction vector in real space
+        The calculation is done element by element with a fixed order of
+        operations, so a point gives exactly the same direction vector 
+        whether it is given alone or in an array with other points.
+        
+        input - pixel coordinates (eta, zeta) seen by the camera, either two
+                numbers or two (N,) arrays
+        output - direction vector in real space (array, 3), or an (N,3) 
+                 array with the unit direction vectors of the N points
         '''
-        # self.calc_R()
+        if ndim(eta) == 0:
+            r = self.get_r_components(float(eta), float(zeta))
+            norm = sqrt(r[0]*r[0] + r[1]*r[1] + r[2]*r[2])
+            return array([r[0]/norm, r[1]/norm, r[2]/norm])
+        
+        eta = asarray(eta, dtype=float).reshape(-1)
+        zeta = asarray(zeta, dtype=float).reshape(-1)
+        r = empty((len(eta), 3))
+        for j, r_j in enumerate(self.get_r_components(eta, zeta)):
+            r[:,j] = r_j
+        norm = npsqrt(r[:,0]*r[:,0] + r[:,1]*r[:,1] + r[:,2]*r[:,2])
+        r /= norm[:,None]
+        return r
+    
+    
+    def get_r_components(self, eta, zeta):
+        '''
+        Returns the three components of ([eta, zeta, f] + e) * [R], before
+        the normalization, for eta and zeta that are either floats or 
+        arrays. The same operations are used in both cases.
+        '''
+        R = self.R.tolist()
         eta_ = eta - self.resolution[0]/2.0 - self.xh
         zeta_ = zeta - self.resolution[1]/2.0  - self.yh
         
+        e = self.get_e(eta, zeta)
+        v0, v1, v2 = -eta_ - e[0], -zeta_ - e[1], -self.f - e[2]
+        return [v0*R[0][j] + v1*R[1][j] + v2*R[2][j] for j in range(3)]
+    
+    
+    def get_Z3(self, eta, zeta):
+        '''
+        Returns the list of polynomial terms Z3 of the correction for pixel
+        coordinates given as floats or arrays; the quadratic terms if E has 
+        5 columns, or the cubic terms if E has 9 columns.
+        '''
+        Z3 = [eta, zeta, eta*eta, zeta*zeta, eta * zeta]
+        if self.E.shape[1] == 9:
+            Z3 += [eta*eta*eta, eta*eta*zeta, eta*zeta*zeta, zeta*zeta*zeta]
+        return Z3
+    
+    
+    def set_correction_order(self, order):
+        '''
+        Sets the order of the correction polynomial; 2 for the quadratic 
+        terms (E is 3X5) or 3 for the cubic terms (E is 3X9). The existing
+        coefficients of the quadratic terms are kept.
+        '''
+        if order not in [2, 3]:
+            raise ValueError('the correction order must be 2 or 3')
+        E = zeros((3, {2: 5, 3: 9}[order]))
+        n = min(E.shape[1], self.E.shape[1])
+        E[:,:n] = self.E[:,:n]
+        self.E = E
+    
+    
+    def get_correction_order(self):
+        '''Returns the order of the correction polynomial, 2 or 3, according
+        to the number of columns in E (see set_correction_order).'''
+        return 3 if self.E.shape[1] == 9 else 2
+    
+    
+    def get_e(self, eta, zeta):
+        '''
+        e = [E] * Z3
         
-        Z3 = [eta, zeta, eta**2, zeta**2, eta * zeta]
-        #Z3 = [eta, zeta, eta**2, zeta**2, eta * zeta, 
-        #      eta**3, eta**2*zeta, eta*zeta**2, zeta**3]
-        
-        e = dot(self.E, Z3)
-        
-        r = dot(array([-eta_, -zeta_, -self.f]) - e, self.R)
-        r = r / (r[0]**2 + r[1]**2 + r[2]**2)**0.5
-        return r
+        Returns the three components of the correction term for pixel 
+        coordinates given as floats or arrays, summing the polynomial terms
+        in a fixed order.
+        '''
+        Z3 = self.get_Z3(eta, zeta)
+        
+        e = []
+        for E_k in self.E.tolist():
+            e_k = E_k[0] * Z3[0]
+            for i in range(1, len(Z3)):
+                e_k = e_k + E_k[i] * Z3[i]
+            e.append(e_k)
+        return e
     
     
     def projection(self, x, correction=True):
         '''
         will return the image coordinate (eta, zeta) of a real point x.
         
-        input - x (array,3) - real world coordinates
+        input - x (array,3) - real world coordinates, or an (N,3) array with
+                              N points that are all projected at once
                 correction - if True, will return the coordinates after
                 the non-linear error correction. If False, we not do the
                 correction.
         output - (eta, zeta) (array,2) - camera coordinates of the projection 
-                                         of x
+                                         of x, or an (N,2) array for N points
         '''
+        x = asarray(x, dtype=float)
         B = x - self.O
-        b = B / (B[0]**2 + B[1]**2 + B[2]**2)**0.5
-        v = dot(b, inv(self.R))
-        a =  v[2] / self.f
-        eta_ = v[0] / a  + self.resolution[0]/2 + self.xh
-        zeta_ = v[1] / a + self.resolution[1]/2 + self.yh
+        b = B / npsqrt(B[...,0]**2 + B[...,1]**2 + B[...,2]**2)[...,None]
+        v = dot(b, self.Rinv)
+        a =  v[...,2] / self.f
+        eta_ = v[...,0] / a  + self.resolution[0]/2 + self.xh
+        zeta_ = v[...,1] / a + self.resolution[1]/2 + self.yh
         
         # add the error correction term.
         if correction:
             eta, zeta = self.eta_zeta_from_bRinv(eta_, zeta_)
-            return array([eta, zeta])
         
         # do not use the error correction term.
         else:
-            return array([eta_, zeta_])
+            eta, zeta = eta_, zeta_
+        
+        if x.ndim == 1:
+            return array([eta, zeta])
+        return column_stack([eta, zeta])
     
     
     def eta_zeta_from_bRinv(self, eta_, zeta_):
@@ -243,29 +357,31 @@ class camera(object):
         the projection equation is 
         [eta, zeta, f] = b * [R]^-1 + e(eta, zeta)
         This function returns (eta, zeta) for an input of b*[R]^-1
-        by solving a least squares equation
+        by solving a least squares equation. eta_ and zeta_ can be numbers
+        or arrays of N points.
         '''
         
-        Z3 = [eta_, zeta_, eta_**2, zeta_**2, eta_ * zeta_]
-        #Z3 = [eta_, zeta_, eta_**2, zeta_**2, eta_ * zeta_,
-        #      eta_**3, eta_**2*zeta_, eta_*zeta_**2, zeta_**3]
-        e_ = dot(self.E, Z3)
+        e_ = self.get_e(eta_, zeta_)
         
         e_0 = e_[0]
-        a, b, c, d, ee = self.E[0,:]
+        a, b, c, d, ee = self.E[0,:5]
         e_eta_0 = a + 2*c*eta_ + ee*zeta_
         e_zeta_0 = b + 2*d*zeta_ + ee*eta_
-        #a, b, c, d, ee, f, g, h, i = self.E[0,:]
-        #e_eta_0 = a + 2*c*eta_ + ee*zeta_ + 3*f*eta_**2 + 2*g*eta_*zeta_ + h*zeta_**2
-        #e_zeta_0 = b + 2*d*zeta_ + ee*eta_ + g*eta_**2 + 2*h*eta_*zeta_ + 3*i*zeta_**2
         
         e_1 = e_[1]
-        a, b, c, d, ee = self.E[1,:]
+        a, b, c, d, ee = self.E[1,:5]
         e_eta_1 = a + 2*c*eta_ + ee*zeta_
         e_zeta_1 = b + 2*d*zeta_ + ee*eta_
-        #a, b, c, d, ee, f, g, h, i = self.E[1,:]
-        #e_eta_1 = a + 2*c*eta_ + ee*zeta_ + 3*f*eta_**2 + 2*g*eta_*zeta_ + h*zeta_**2
-        #e_zeta_1 = b + 2*d*zeta_ + ee*eta_ + g*eta_**2 + 2*h*eta_*zeta_ + 3*i*zeta_**2
+        
+        # the derivatives of the cubic terms
+        if self.E.shape[1] == 9:
+            f, g, h, i = self.E[0,5:]
+            e_eta_0 = e_eta_0 + 3*f*eta_**2 + 2*g*eta_*zeta_ + h*zeta_**2
+            e_zeta_0 = e_zeta_0 + g*eta_**2 + 2*h*eta_*zeta_ + 3*i*zeta_**2
+            
+            f, g, h, i = self.E[1,5:]
+            e_eta_1 = e_eta_1 + 3*f*eta_**2 + 2*g*eta_*zeta_ + h*zeta_**2
+            e_zeta_1 = e_zeta_1 + g*eta_**2 + 2*h*eta_*zeta_ + 3*i*zeta_**2
         
         A11 = 1.0 + e_eta_0
         A12 = e_zeta_0
@@ -275,19 +391,62 @@ class camera(object):
         rhs1 = eta_*(1.0 + e_eta_0) + zeta_*e_zeta_0 - e_0
         rhs2 = zeta_*(1.0 + e_zeta_1) + eta_*e_eta_1 - e_1
         
-        Ainv = array([[A22, -A12],[-A21, A11]]) / (A11*A22 - A12*A21)
-        eta, zeta = dot(Ainv, [rhs1, rhs2])
+        det = A11*A22 - A12*A21
+        eta = (A22*rhs1 - A12*rhs2) / det
+        zeta = (A11*rhs2 - A21*rhs1) / det
         
         return eta, zeta
     
     
     
-    def save(self, dir_path = ''):
+    def get_parameters_hash(self):
+        '''
+        Returns a hash string (md5, hexadecimal) of the camera parameters, 
+        which changes whenever any of the parameters change.
+        '''
+        from hashlib import md5
+        h = md5()
+        for val in [self.O, self.theta, self.f, self.xh, self.yh, self.E,
+                    self.resolution]:
+            h.update(array(val, dtype=float).tobytes())
+        return h.hexdigest()
+    
+    
+    def get_parameters(self):
+        '''
+        Returns a dictionary with the camera parameters in camera_fields,
+        as arrays of floats.
+        '''
+        return dict([(k, array(getattr(self, k), dtype=float)) 
+                     for k in camera_fields])
+    
+    
+    def set_parameters(self, params):
+        '''
+        Sets the camera parameters from a dictionary like the one of 
+        get_parameters.
+        '''
+        self.O = array(params['O'], dtype=float)
+        self.theta = array(params['theta'], dtype=float)
+        self.f = float(params['f'])
+        self.xh, self.yh = float(params['xh']), float(params['yh'])
+        self.E = array(params['E'], dtype=float)
+        self.resolution = tuple([float(r) for r in params['resolution']])
+        self.calc_R()
+    
+    
+    def save(self, dir_path = '', fmt = 'text'):
         '''
-        will save the camera on the hard drive
+        will save the camera on the hard drive. If fmt is 'npz', the 
+        camera is saved in the binary format as <name>.npz (see 
+        save_cameras), and otherwise in the text format as <name>.
         '''
         full_path = os.path.join(dir_path, self.name)
         
+        if fmt == 'npz':
+            save_cameras([self], full_path + '.npz')
+            return
+        
         f = open(full_path, 'w')
         f.write(self.name+'\n')
         
@@ -320,10 +479,21 @@ class camera(object):
         
     def load(self, dir_path):
         '''
-        will load camera data from the hard disk
+        will load camera data from the hard disk; the text format file 
+        <name> is used if it exists, and otherwise the binary <name>.npz.
         '''
         full_path = os.path.join(dir_path, self.name)
         
+        if not os.path.exists(full_path) and \
+           os.path.exists(full_path + '.npz'):
+            cams = [cam for cam in read_cameras(full_path + '.npz') 
+                    if cam.name == self.name]
+            if len(cams) == 0:
+                raise ValueError('camera %s is not in %s'%(self.name, 
+                                                         full_path + '.npz'))
+            self.set_parameters(cams[0].get_parameters())
+            return
+        
         f = open(full_path, 'r')
         name = f.readline()
         
@@ -338,9 +508,12 @@ class camera(object):
         S = f.readline()[:-2]
         self.xh, self.yh = array([float(s) for s in S.split()])
         
+        # the number of columns of E depends on the correction order
+        E = []
         for i in range(3):
             S = f.readline()[:-2]
-            self.E[i,:] = array([float(s) for s in S.split()])
+            E.append([float(s) for s in S.split()])
+        self.E = array(E)
         
         f.close()
         
@@ -389,6 +562,270 @@ class camera(object):
 
 
 
+class epipolar_pair(object):
+    '''
+    The epipolar geometry of a pair of cameras, used to find the blobs in 
+    camera 2 that can match blobs in camera 1.
+    
+    The ray of a blob in camera 1 is cut to the part that lies inside the 
+    region of interest, and projected onto camera 2 as an epipolar curve. 
+    The epipolar lines of a camera pair all pass through the epipole (the
+    projection of camera 1's center onto camera 2), so each curve is 
+    described by its range of angles and of distances from the epipole. 
+    The blobs of camera 2 are sorted by their angle about the epipole, and
+    the candidates of each blob of camera 1 are found with a binary search 
+    in this list, which takes O(N log N) for N blobs instead of depending 
+    on the size of the region of interest.
+    
+    When the baseline is (nearly) parallel to the image plane of camera 2,
+    the epipole is at infinity, or very far from the image, and the 
+    epipolar lines are (nearly) parallel. The angles about the epipole are
+    then meaningless, so the lines are instead described by their offset
+    perpendicular to the common direction of the lines and by the position
+    along it; the search is the same, with the offsets in place of the 
+    angles.
+    
+    Since the lens distortion bends the epipolar lines a little, the 
+    epipole is taken without the distortion correction, and the curves 
+    are sampled at several points.
+    '''
+    
+    def __init__(self, cam1, cam2, RIO, n_samples=8, max_epipole_dist=100):
+        '''
+        cam1, cam2 - the camera objects
+        RIO - A nested list of 3X2 elements with the minimum and maximum 
+              values of the x, y and z coordinates of the region of 
+              interest.
+        n_samples - the number of points at which the epipolar curves are
+                    sampled.
+        max_epipole_dist - if the epipole is farther than this number of
+                           image diagonals from the image center (or is not
+                           finite), the epipolar lines are taken as 
+                           parallel.
+        '''
+        from numpy import isfinite, hypot, errstate
+        self.cam1 = cam1
+        self.cam2 = cam2
+        self.RIO = array(RIO, dtype=float)
+        self.n_samples = n_samples
+        
+        with errstate(divide='ignore', invalid='ignore', over='ignore'):
+            self.epipole = cam2.projection(cam1.O, correction=False)
+        res = cam2.resolution
+        dist = hypot(self.epipole[0] - res[0]/2, self.epipole[1] - res[1]/2)
+        self.parallel = not (isfinite(dist) and 
+                             dist <= max_epipole_dist * hypot(res[0], res[1]))
+        
+        if self.parallel:
+            # the direction of the epipolar lines is the image of the 
+            # baseline, taken at the center of the region of interest
+            Xc = self.RIO.mean(axis=1)
+            B = cam1.O - cam2.O
+            B = B / sqrt(dot(B, B)) * 1e-3 * sqrt(dot(Xc - cam2.O, 
+                                                      Xc - cam2.O))
+            d = (cam2.projection(Xc + B, correction=False) - 
+                 cam2.projection(Xc, correction=False))
+            self.direction = d / sqrt(dot(d, d))
+        
+        
+    def get_polar(self, xy):
+        '''Returns the coordinates of (N,2) image coordinates of camera 2
+        in which the epipolar lines are searched: the angles, in [-pi, pi],
+        and the distances about the epipole, or, for parallel epipolar 
+        lines, the perpendicular offsets and the positions along the 
+        lines.'''
+        from numpy import arctan2, hypot
+        if self.parallel:
+            d0, d1 = self.direction
+            return (d0*xy[:,1] - d1*xy[:,0]), (d0*xy[:,0] + d1*xy[:,1])
+        d0, d1 = xy[:,0] - self.epipole[0], xy[:,1] - self.epipole[1]
+        return arctan2(d1, d0), hypot(d0, d1)
+    
+    
+    def get_curves(self, r1):
+        '''
+        For (N,3) ray directions of blobs in camera 1, returns the extent of 
+        their epipolar curves in camera 2: the center angle, the angular 
+        range relative to it, the range of distances from the epipole, and
+        a mask of the rays that pass through the region of interest (for
+        parallel epipolar lines, the offsets and the positions along the 
+        lines take the place of the angles and the distances).
+        '''
+        from numpy import minimum, maximum, linspace, pi, errstate, inf
+        from numpy import isfinite
+        O = self.cam1.O
+        r1 = asarray(r1, dtype=float)
+        
+        # the part of each ray (line) inside the RIO box
+        with errstate(divide='ignore', invalid='ignore'):
+            a_lo = (self.RIO[:,0] - O) / r1
+            a_hi = (self.RIO[:,1] - O) / r1
+        a_lo, a_hi = minimum(a_lo, a_hi), maximum(a_lo, a_hi)
+        a_lo[~isfinite(a_lo)] = -inf
+        a_hi[~isfinite(a_hi)] = inf
+        a0 = a_lo.max(axis=1)
+        a1 = a_hi.min(axis=1)
+        valid = a1 > a0
+        a0, a1 = a0[valid], a1[valid]
+        
+        # project sample points of the rays onto camera 2
+        t = linspace(0, 1, self.n_samples)
+        a = a0[:,None] + (a1 - a0)[:,None] * t
+        X = O + a[:,:,None] * r1[valid][:,None,:]
+        xy = self.cam2.projection(X.reshape(-1, 3))
+        theta, rho = self.get_polar(xy)
+        theta = theta.reshape(-1, self.n_samples)
+        rho = rho.reshape(-1, self.n_samples)
+        
+        # angles relative to the curve center, wrapped to [-pi, pi]
+        center = theta[:, self.n_samples//2]
+        if self.parallel:
+            dtheta = theta - center[:,None]
+        else:
+            dtheta = (theta - center[:,None] + pi) % (2*pi) - pi
+        return (center, dtheta.min(axis=1), dtheta.max(axis=1), 
+                rho.min(axis=1), rho.max(axis=1), valid)
+    
+    
+    def get_candidates(self, r1, xy2, max_dist):
+        '''
+        Returns the pairs of blobs whose image in camera 2 lies within a
+        distance of about max_dist (in pixels) from the epipolar curve of 
+        the blob in camera 1.
+        
+        input - 
+        r1 (array, N1x3) - ray directions of the blobs in camera 1
+        xy2 (array, N2x2) - image coordinates of the blobs in camera 2
+        max_dist (float) - the half width of the epipolar band in pixels
+        
+        output - 
+        i1, i2 (arrays of int) - the indexes of the candidate pairs in the
+                                 two lists of blobs
+        '''
+        from numpy import argsort, searchsorted, concatenate, pi
+        from numpy import minimum, maximum, nonzero
+        xy2 = asarray(xy2, dtype=float).reshape(-1, 2)
+        if len(r1) == 0 or len(xy2) == 0:
+            return zeros(0, dtype=int), zeros(0, dtype=int)
+        
+        theta2, rho2 = self.get_polar(xy2)
+        order = argsort(theta2)
+        theta2_sorted = theta2[order]
+        
+        center, dmin, dmax, rho_min, rho_max, valid = self.get_curves(r1)
+        if self.parallel:
+            tol = max_dist
+        else:
+            tol = minimum(max_dist / maximum(rho_min, 1e-9), pi)
+        lo = center + dmin - tol
+        hi = center + dmax + tol
+        
+        i1, i2 = [], []
+        for k, i in enumerate(nonzero(valid)[0]):
+            
+            # the angular band, as one or two ranges of the sorted angles 
+            if self.parallel:
+                ranges = [(lo[k], hi[k])]
+            elif hi[k] - lo[k] >= 2*pi:
+                ranges = [(-pi, pi)]
+            else:
+                l = (lo[k] + pi) % (2*pi) - pi
+                h = l + hi[k] - lo[k]
+                ranges = [(l, min(h, pi))]
+                if h > pi:
+                    ranges.append((-pi, h - 2*pi))
+            
+            cand = concatenate([order[searchsorted(theta2_sorted, l):
+                                      searchsorted(theta2_sorted, h, 
+                                                   side='right')]
+                                for l, h in ranges])
+            
+            # keep the blobs within the radial extent (or the extent 
+            # along the parallel lines) of the curve
+            rho_c = rho2[cand]
+            cand = cand[(rho_c >= rho_min[k] - max_dist) & 
+                        (rho_c <= rho_max[k] + max_dist)]
+            i1.append(zeros(len(cand), dtype=int) + i)
+            i2.append(cand)
+        
+        if len(i1) == 0:
+            return zeros(0, dtype=int), zeros(0, dtype=int)
+        return concatenate(i1), concatenate(i2)
+    
+    
+    
+    
+    
+    
+    
+def save_cameras(cameras, fname):
+    '''
+    Saves a list of cameras in a single binary .npz file. The file holds 
+    two arrays: 'cameras' with the name of each camera and the hash of its
+    parameters, which is checked when the file is read, and 'params' with 
+    the parameters of the cameras one after the other. For each camera, 
+    'params' has the number of its parameters followed by the parameters 
+    in the order of camera_fields (O, theta, f, xh, yh, resolution, E).
+    
+    input - 
+    cameras - a list of camera objects
+    fname - the path of the file
+    '''
+    from numpy import savez, concatenate
+    ids = array([[cam.name, cam.get_parameters_hash()] for cam in cameras])
+    params = []
+    for cam in cameras:
+        p = cam.get_parameters()
+        v = concatenate([p[k].ravel() for k in camera_fields])
+        params += [[len(v)], v]
+    savez(fname, cameras=ids, params=concatenate(params))
+    
+    
+def read_cameras(fname):
+    '''
+    Reads a list of cameras from a .npz file made with save_cameras, and 
+    raises a ValueError if the parameters of a camera do not match its
+    hash.
+    '''
+    from numpy import load
+    cameras = []
+    with load(fname) as data:
+        ids, params = data['cameras'], data['params']
+    
+    i = 0
+    for name, h in ids:
+        n = int(params[i])
+        v = params[i+1:i+1+n]
+        i += n + 1
+        p = {'O': v[0:3], 'theta': v[3:6], 'f': v[6], 'xh': v[7], 
+             'yh': v[8], 'resolution': v[9:11], 'E': v[11:].reshape(3, -1)}
+        cam = camera(str(name), tuple(p['resolution']))
+        cam.set_parameters(p)
+        if cam.get_parameters_hash() != str(h):
+            raise ValueError('camera %s in %s is corrupted'%(name, fname))
+        cameras.append(cam)
+    return cameras
+    
+    
+def load_cameras(fname):
+    '''
+    Returns the list of cameras in a .npz file made with save_cameras. The
+    cameras are read once and kept in a cache by the file's path, so 
+    loading the same file again returns the same camera objects; a file 
+    that was changed (has a new modification time) is read again and 
+    replaces the older version in the cache.
+    '''
+    path, mtime = os.path.abspath(fname), os.stat(fname).st_mtime_ns
+    if path not in _cameras_cache or _cameras_cache[path][0] != mtime:
+        _cameras_cache[path] = (mtime, read_cameras(fname))
+    return list(_cameras_cache[path][1])
+    
+    
+    
+    
+    
+    
+    
 class Cal_image_coord(object):
     '''
     A class used for reading the calibration image files. This is called
@@ -22,16 +22,28 @@ algorithm.
 
 """
 
-from myptv.utils import line_dist
+from myptv.utils import nearest_point_to_rays, mean_ray_pair_distance
 from math import ceil, floor
 from itertools import combinations, product
-from numpy import loadtxt, savetxt, array
+from numpy import loadtxt, savetxt, array, zeros
 from scipy.spatial import KDTree
 
 from pandas import read_csv
 
 
 
+def get_camera_rays(cam, blobs):
+    '''
+    Returns the direction vectors of the rays of a list of blobs in a 
+    camera as an (N,3) array.
+    '''
+    eta = array([b[0] for b in blobs], dtype=float)
+    zeta = array([b[1] for b in blobs], dtype=float)
+    return cam.get_r(eta, zeta)
+
+
+
+
 class match_blob_files(object):
     '''A class for obtaining triangulated particles positions from a 
     list of segmented blobs. Use self.get_particles() and after that,
@@ -39,7 +51,7 @@ class match_blob_files(object):
     
     
     def __init__(self, blob_fnames, img_system, RIO, voxel_size, max_blob_dist,
-                 max_err=1e9, reverse_eta_zeta = False):
+                 max_err=1e9, reverse_eta_zeta = False, epipolar_band=None):
         '''
         blob_fname - a list of the file names containing the segmented blob
                      data. The list has to be sorted according the order of
@@ -68,6 +80,10 @@ class match_blob_files(object):
                            data points were given where the x, y coordinates
                            are transposed (as happens, e.g., if using 
                            matplotlib.pyplot.imshow).
+        
+        epipolar_band - None, or the half width of the epipolar bands (in 
+                        pixels) that are used to find the candidates in the
+                        matching instead of the voxels (see matching).
         '''
         self.blobs = []
         for fn in blob_fnames:
@@ -80,6 +96,7 @@ class match_blob_files(object):
         self.reverse_eta_zeta = reverse_eta_zeta
         self.max_blob_dist = max_blob_dist
         self.max_err = max_err
+        self.epipolar_band = epipolar_band
         
         time_lst = []
         for bl in self.blobs:
@@ -161,7 +178,8 @@ class match_blob_files(object):
                 itm = initiate_time_matching(self.imsys, pd, pd1, 
                                              self.max_blob_dist, self.RIO, 
                                              self.voxel_size, 
-                                             max_err = self.max_err)
+                                             max_err = self.max_err,
+                                           epipolar_band = self.epipolar_band)
                 itm.choose_blobs_with_neghbours()
                 itm.match_blobs_with_neighbours()
                 for p in itm.matched_particles:
@@ -170,7 +188,8 @@ class match_blob_files(object):
                                 
             # match particles using the matching object
             M = matching(self.imsys, pd, self.RIO, self.voxel_size,
-                         max_err = self.max_err)
+                         max_err = self.max_err, 
+                         epipolar_band = self.epipolar_band)
             #return M  # <-- used for checks
             M.get_voxel_dictionary()
             M.list_candidates()
@@ -240,11 +259,15 @@ class matching(object):
         3) self.get_particles()
     After running these three functions the attribute self.matched_particles
     holds the results of triangulation.
+    
+    If epipolar_band is given, the candidates are found with the epipolar
+    geometry of the camera pairs (imaging_mod.epipolar_pair) instead of 
+    the ray traversal through voxels.
     '''
     
     
     def __init__(self, img_system, particles_dic, 
-                 RIO, voxel_size, max_err=None):
+                 RIO, voxel_size, max_err=None, epipolar_band=None):
         '''
         img_system - is an instance of the img_system object with camera 
                      objects. 
@@ -261,6 +284,10 @@ class matching(object):
                      algorithm. Given in lab coordinate scales (e.g. mm).
         max_err - maximum allowable triangulation rms error.
         
+        epipolar_band - None, or the half width of the epipolar bands in 
+                        image space coordinates (pixels). If given, the 
+                        candidates are blobs that lie within the epipolar
+                        bands of each other, and voxel_size is not used.
         '''
         
         self.imsys = img_system
@@ -274,14 +301,26 @@ class matching(object):
             particles_i = particles_dic[cam.name]
             self.ray_camera_indexes.append(len(particles_i) + 
                                            self.ray_camera_indexes[-1])
+            if len(particles_i) == 0:
+                continue
+            
+            # the directions of all the camera's rays are found at once
+            r_i = get_camera_rays(cam, particles_i)
             for j in range(len(particles_i)):
                 x, y = particles_i[j][0], particles_i[j][1]
-                r_ij = cam.get_r(x, y)
-                self.rays.append( (x, y, (i,j), r_ij) )
+                self.rays.append( (x, y, (i,j), r_i[j]) )
+        
+        # arrays of the rays' origins and directions, for the triangulation
+        self.ray_O = zeros((len(self.rays), 3))
+        self.ray_r = zeros((len(self.rays), 3))
+        for k, ray in enumerate(self.rays):
+            self.ray_O[k] = self.imsys.cameras[ray[2][0]].O
+            self.ray_r[k] = ray[3]
         
         self.RIO = RIO
         self.voxel_size = voxel_size
         self.max_err = max_err
+        self.epipolar_band = epipolar_band
 
         # set up lists of voxel centers:
             
@@ -315,7 +354,7 @@ class matching(object):
         '''
         cam  = self.imsys.cameras[ray[2][0]]
         O = cam.O
-        r = cam.get_r(ray[0], ray[1])
+        r = ray[3]
         r_ = r / sum(r**2)**0.5
 
         a1, a2 = (self.RIO[2][0] - O[2])/r_[2], (self.RIO[2][1] - O[2])/r_[2]
@@ -377,7 +416,11 @@ class matching(object):
     
     def get_voxel_dictionary(self):
         '''This generates a dicionary who's keys are voxel indexes and
-        who's values are the rays that passed through this voxel.'''
+        who's values are the rays that passed through this voxel. This is
+        not needed (and skipped) if the epipolar bands are used.'''
+        
+        if self.epipolar_band is not None:
+            return
 
         self.traversed_voxels = []
         for ray in self.rays:
@@ -400,7 +443,12 @@ class matching(object):
         
         Candidates are based on the voxels of voxel_dic, while calculating the 
         RMS and the maximum distance between the estimated particle location 
-        and the epipolar lines.'''
+        and the epipolar lines. If epipolar_band is given, the candidates are
+        found with list_candidates_epipolar instead.'''
+        
+        if self.epipolar_band is not None:
+            self.list_candidates_epipolar()
+            return
         
         self.candidate_dic = {}
         group_sizes = range(2, len(self.imsys.cameras)+1)
@@ -425,31 +473,65 @@ class matching(object):
         
 
 
+    def list_candidates_epipolar(self):
+        '''
+        Lists the candidate rays for triangulation using the epipolar 
+        geometry. For each pair of cameras, the pairs of rays whose blobs lie
+        in each other's epipolar bands are found with a binary search 
+        (imaging_mod.epipolar_pair). Candidates of three or more cameras are
+        the groups of rays in which every two rays are a candidate pair.
+        '''
+        from myptv.imaging_mod import epipolar_pair
+        
+        cams = self.imsys.cameras
+        n_cams = len(cams)
+        ind = self.ray_camera_indexes
+        
+        # the pairs, and the rays of higher cameras paired with each ray
+        self.candidate_dic = {2: []}
+        neighbours = {}
+        for i, j in combinations(range(n_cams), 2):
+            xy_j = [(ray[0], ray[1]) for ray in self.rays[ind[j]:ind[j+1]]]
+            ep = epipolar_pair(cams[i], cams[j], self.RIO)
+            i1, i2 = ep.get_candidates(self.ray_r[ind[i]:ind[i+1]], xy_j, 
+                                       self.epipolar_band)
+            for k1, k2 in zip(i1.tolist(), i2.tolist()):
+                self.candidate_dic[2].append(((i, k1), (j, k2)))
+                neighbours.setdefault((i, k1), set()).add((j, k2))
+        
+        # extend the groups by one camera at a time
+        for gs in range(3, n_cams+1):
+            self.candidate_dic[gs] = []
+            for cand in self.candidate_dic[gs-1]:
+                common = neighbours.get(cand[-1], set())
+                for ray in cand[:-1]:
+                    common = common & neighbours.get(ray, set())
+                for ray in sorted(common):
+                    self.candidate_dic[gs].append(cand + (ray,))
+        
+        
     def triangulate_rays(self, rays):
         '''will return the results of stereo matching of a list of rays'''
+        return self.triangulate_candidates([rays])[0]
+    
+    
+    def triangulate_candidates(self, candidates):
+        '''
+        Triangulates a list of candidates that have the same number of rays
+        at once, using the least squares nearest point to the rays. 
+        Returns a list with (X, cams, error) for each candidate, where the 
+        error is the mean distance between pairs of the rays, as in 
+        img_system.stereo_match.
+        '''
+        if len(candidates) == 0:
+            return []
         
-        dc = {}
-        cams = []
-        for ray in rays:
-            i = self.ray_camera_indexes[ray[0]] 
-            ip1 = self.ray_camera_indexes[ray[0]+1]
-            ri = self.rays[i:ip1][ray[1]][3]
-            Oi = self.imsys.cameras[self.rays[i:ip1][ray[1]][2][0]].O
-            dc[ray[0]] = Oi, ri
-            cams.append(ray[0])
-        
-        n = len(rays)
-        d, x = [], []
-        
-        for i in range(n):
-            Oi, ri = dc[cams[i]]
-            for j in range(i+1, n):
-                Oj, rj = dc[cams[j]]
-                D, x_ij = line_dist(Oi, ri, Oj, rj)
-                d.append(D)
-                x.append(x_ij)
-        
-        return sum(x)/1.0/len(x), cams, sum(d)/1.0/len(x)
+        ind = array([[self.ray_camera_indexes[ray[0]] + ray[1] 
+                      for ray in cand] for cand in candidates])
+        X = nearest_point_to_rays(self.ray_O[ind], self.ray_r[ind])[0]
+        err = mean_ray_pair_distance(self.ray_O[ind], self.ray_r[ind])
+        return [(X[k], [ray[0] for ray in candidates[k]], err[k]) 
+                for k in range(len(candidates))]
 
     
     
@@ -489,7 +571,7 @@ class matching(object):
                 cand_k = list(filter(lambda c: not(self.is_used(c)), cand_k))
             
             # triangulate all the candidate rays
-            ray_crosses = [self.triangulate_rays(cand) for cand in cand_k]                
+            ray_crosses = self.triangulate_candidates(cand_k)                
             
             # zip and sort candidates by RMS error
             dist_sorted_cands = sorted(zip(cand_k, ray_crosses),
@@ -597,10 +679,9 @@ class matching_using_time(object):
            we add the particle to a list self.matched particles.
         '''
         
-        triangulated_particles = []
+        # first, find the nearest neighboring blobs
+        groups = []
         for p in self.prev_used_blobs:
-            
-            # first, find the nearest neighboring blobs
             p_blobs = p[3]
             nearest_blobs_num = {}
             nearest_blobs_coords = {}
@@ -611,27 +692,45 @@ class matching_using_time(object):
                 bn = self.trees[ci].query((x, y))[1]
                 nearest_blobs_num[ci] = bn
                 nearest_blobs_coords[ci] = self.pd[cn][bn]
-                
-            # second, triangulate them:
-            triangulated = self.imsys.\
-                stereo_match(nearest_blobs_coords, 1e9)
             
+            if len(nearest_blobs_num) >= 2:
+                groups.append((nearest_blobs_num, nearest_blobs_coords))
+        
+        # second, triangulate them all at once; the groups are padded to 
+        # the number of cameras and the missing cameras are masked
+        K, n_cams = len(groups), len(self.imsys.cameras)
+        O = zeros((K, n_cams, 3))
+        dirs = zeros((K, n_cams, 3))
+        dirs[:,:,2] = 1.0
+        mask = zeros((K, n_cams), dtype=bool)
+        for ci, cam in enumerate(self.imsys.cameras):
+            ks = [k for k in range(K) if ci in groups[k][1]]
+            if len(ks) == 0:
+                continue
+            dirs[ks, ci] = get_camera_rays(cam, [groups[k][1][ci] for k in ks])
+            O[ks, ci] = cam.O
+            mask[ks, ci] = True
+        
+        if K > 0:
+            X = nearest_point_to_rays(O, dirs, mask)[0]
+            err = mean_ray_pair_distance(O, dirs, mask)
         
-            # third, if the RMS triangulation error is low enough, add the 
-            # triangulation to a list of matched particles
-            if triangulated[2] < self.max_err:
+        # third, if the RMS triangulation error is low enough, add the 
+        # triangulation to a list of matched particles
+        triangulated_particles = []
+        for k in range(K):
+            nearest_blobs_num, nearest_blobs_coords = groups[k]
+            if err[k] < self.max_err:
                 r = [(ci, 
                       (nearest_blobs_num[ci],tuple(nearest_blobs_coords[ci]))) 
                      for ci in nearest_blobs_num.keys()]
                 
-                p = triangulated[0]
-                new_p = []
-                
+                p = X[k]
                 new_p = [round(p[0], ndigits=3), 
                          round(p[1], ndigits=3),
                          round(p[2], ndigits=3),
                          r,
-                         round(triangulated[2], ndigits=3)]
+                         round(err[k], ndigits=3)]
                 
                 triangulated_particles.append(new_p)
         
@@ -683,7 +782,8 @@ class initiate_time_matching(object):
     '''
 
     def __init__(self, img_system, particles_dic_0, particles_dic_1,
-                 max_distance, RIO, voxel_size, max_err=1e9):
+                 max_distance, RIO, voxel_size, max_err=1e9, 
+                 epipolar_band=None):
         '''
         input -
 
@@ -710,6 +810,9 @@ class initiate_time_matching(object):
                      algorithm. Given in lab coordinate scales (e.g. mm).
 
         max_err - maximum allowable RMS triangulation error.
+        
+        epipolar_band - None, or the half width of the epipolar bands used
+                        to find the candidates (see matching).
         '''
         self.imsys = img_system
         self.pd = particles_dic_0
@@ -718,6 +821,7 @@ class initiate_time_matching(object):
         self.max_err = max_err
         self.RIO = RIO
         self.voxel_size = voxel_size
+        self.epipolar_band = epipolar_band
         # we form KDTrees for the nearest neighbour blobs search
         self.trees = {}
         for k in self.pd.keys():
@@ -765,7 +869,8 @@ class initiate_time_matching(object):
 
         # match particles using the matching object
         M = matching(self.imsys, self.new_pd, self.RIO, self.voxel_size,
-                     max_err = self.max_err)
+                     max_err = self.max_err, 
+                     epipolar_band = self.epipolar_band)
         #return M  # <-- used for checks
         M.get_voxel_dictionary()
         M.list_candidates()
@@ -8,12 +8,34 @@ Created on Fri Dec  7 18:02:07 2018
 contains a class for segmentation of circular particles
 """
 
-from numpy import zeros, savetxt
-from scipy.ndimage import gaussian_filter
+from numpy import zeros, savetxt, ones, arange, argsort, flatnonzero
+from numpy import unique, column_stack, unravel_index, empty, bincount
+from numpy import concatenate, cumsum, minimum, maximum, round as npround
+from numpy import intp, floor, subtract, array, greater
+from time import perf_counter
+from scipy.ndimage import gaussian_filter, uniform_filter, label
 from skimage.io import imread
 
 
 
+
+# the fields of the blob arrays returned by particle_segmentation
+blob_dtype = [('x', 'f8'), ('y', 'f8'), ('size_x', 'i8'), ('size_y', 'i8'),
+              ('area', 'i8')]
+
+# the blob size criteria, in the order of the bbox and area limits
+size_criteria = ['min_xsize', 'max_xsize', 'min_ysize', 'max_ysize', 
+                 'min_area', 'max_area']
+
+# the entries of the timing dictionaries of the loop segmentation: the time
+# spent reading images, waiting for images to be read, segmenting images, 
+# and the total time, in seconds
+timing_keys = ['read', 'io_wait', 'compute', 'total']
+
+# the format of the columns in the blob files
+blob_file_fmt = ['%.02f','%.02f','%d','%d','%d','%d']
+
+
 class particle_segmentation(object):
     '''a class for segmenting out particles (blobs) for a given image'''
     
@@ -22,51 +44,221 @@ class particle_segmentation(object):
                  local_filter = 15,
                  min_xsize=None, max_xsize=None,
                  min_ysize=None, max_ysize=None,
-                 min_area=None, max_area=None):
+                 min_area=None, max_area=None, labeling='vectorized',
+                 background=None, ROI=None, tile_size=None, n_threads=1,
+                 precision='float32', buffers=None):
+        '''
+        image - the image for segmentation
         
-        self.im = image
+        background - None, or an array with the image shape holding a static
+                     background (see temporal_background) that is 
+                     subtracted from the image before the filtering. With a
+                     background, the local filter can usually be turned off
+                     (local_filter=None).
+        
+        ROI - None, or a region of interest given as the pixel limits
+              (xmin, xmax, ymin, ymax), where x is the column index and y is
+              the row index (as in imshow), and the limits are included. The 
+              image (and the mask and background, if they are arrays) is 
+              cropped to the ROI before any filtering, and the blob 
+              coordinates are shifted back to the full image coordinates.
+              The crop includes a margin as wide as the filters, so the 
+              filtered image inside the ROI is the same as for the full 
+              image. 
+        
+        tile_size - None, or an integer. If an integer is given, the image
+                    is segmented in square tiles of this size (each filtered 
+                    with a margin as wide as the filters), and blobs that 
+                    cross tile boundaries are merged. This bounds the memory
+                    of the filtering temporaries by the tile size.
+        
+        n_threads - the number of threads over which the tiles are spread.
+        
+        precision - the floating point type of the filtered images, either 
+                    'float32' (default) or 'float64'. The binary image is 
+                    boolean and the label image holds int32 labels.
+        
+        buffers - None, or a dictionary in which the work arrays (the 
+                  filtered, binary and label images) are kept, so they can 
+                  be reused when the next frame, of the same shape, is 
+                  segmented with the same dictionary. Note that the 
+                  bin_im and labeled attributes are then overwritten by 
+                  the next frame.
+        
+        The rest are the segmentation parameters.
+        '''
+        self.full_im = image
+        self.ROI = ROI
         self.sigma = sigma
+        self.loc_filter = local_filter
+        
+        if ROI is not None:
+            c0, c1, r0, r1 = [int(val) for val in ROI]
+            h = self.get_filters_margin()
+            rr0, rr1 = max(0, r0-h), min(image.shape[0], r1+1+h)
+            cc0, cc1 = max(0, c0-h), min(image.shape[1], c1+1+h)
+            self.offset = (rr0, cc0)
+            self.ROI_in_crop = (r0-rr0, r1+1-rr0, c0-cc0, c1+1-cc0)
+            crop = lambda a: a[rr0:rr1, cc0:cc1] if hasattr(a, 'shape') \
+                             and a.shape == image.shape else a
+            image, mask, background = crop(image), crop(mask), \
+                                      crop(background)
+        else:
+            self.offset = (0, 0)
+            self.ROI_in_crop = (0, image.shape[0], 0, image.shape[1])
+        
+        self.im = image
         self.th = threshold
+        
+        # the blobs are made of pixels where the mask is 1
+        if hasattr(mask, 'shape') and mask.dtype != bool:
+            mask = mask == 1
         self.mask = mask
         self.bbox_limits = (min_xsize, max_xsize, min_ysize, max_ysize)
         self.area_limits = (min_area, max_area)
-        self.loc_filter = local_filter
         
+        if labeling not in ['vectorized', 'legacy']:
+            msg = "labeling must be either 'vectorized' or 'legacy'."
+            raise ValueError(msg)
+        self.labeling = labeling
+        
+        if precision not in ['float32', 'float64']:
+            msg = "precision must be either 'float32' or 'float64'."
+            raise ValueError(msg)
+        self.precision = precision
+        self.buffers = buffers
+        self.background = background
+        self.tile_size = tile_size
+        self.n_threads = n_threads
+        
+    
+    def get_filters_margin(self):
+        '''Returns the number of pixels around each pixel that affect its
+        value after the Gaussian blur and the local filter.'''
+        h = 0
+        if self.sigma is not None:
+            h += int(4.0 * self.sigma + 0.5)
+        if self.loc_filter is not None:
+            h += int(self.loc_filter) // 2
+        return h
+    
+    
+    def get_buffer(self, name, shape, dtype, reuse=True):
+        '''Returns a work array with the given shape and dtype. If a buffers
+        dictionary was given (and reuse is True), the array kept in it under
+        this name is reused when it fits, and is replaced otherwise.'''
+        if self.buffers is None or not reuse:
+            return empty(shape, dtype=dtype)
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = empty(shape, dtype=dtype)
+            self.buffers[name] = buf
+        return buf
     
-    def local_filter(self, image):
+    
+    def subtract_background(self, image, background, out=None):
+        '''Returns a floating point copy of the image with the static 
+        background subtracted (negative values are set to 0).'''
+        out = subtract(image, background, out=out, dtype=self.precision)
+        maximum(out, 0, out=out)
+        return out
+        
+    
+    def local_filter(self, image, out=None, local_mean=None):
         '''returns a new image where the local mean neighbourhood of
-        each pixel is subtracted.'''
-        from numpy import ones
-        from scipy.signal import convolve2d
-        w = self.loc_filter
-        window = ones((w, w)) / w**2
-        local_mean = convolve2d(image, window, mode='same')
-        new_im = image - local_mean
-        new_im[new_im<0] = 0
-        new_im = new_im.astype('int')
-        return new_im
-        
-        
-    def get_binary_image(self):
+        each pixel is subtracted. 
+        
+        The local mean is a uniform filter (separable, so the cost per pixel 
+        does not depend on the window size) with zero padding at the image 
+        edges. The result is a floating point image (see precision), rounded
+        down to whole brightness values. If out is given (an array with the 
+        image shape) the result is written into it; out can be the image 
+        itself to do the filtering in place. local_mean is an optional array
+        with the image shape used for the local mean.'''
+        if out is None:
+            out = image.astype(self.precision)
+        elif out is not image:
+            out[...] = image
+        
+        local_mean = uniform_filter(out, self.loc_filter, output=local_mean,
+                                    mode='constant')
+        out -= local_mean
+        maximum(out, 0, out=out)
+        floor(out, out=out)
+        return out
+        
+        
+    def blur_and_remove_background(self, image, out=None, local_mean=None):
+        '''Returns the image after the Gaussian blur and the local mean
+        subtraction (see local_filter). The blurred image is written directly
+        into the floating point output and filtered in place, so it is not 
+        kept separately. out and local_mean are optional arrays with the 
+        image shape.'''
+        if out is None:
+            out = empty(image.shape, dtype=self.precision)
+        gaussian_filter(image, self.sigma, output=out)
+        return self.local_filter(out, out=out, local_mean=local_mean)
+        
+        
+    def get_binary_image(self, window=None):
         '''Will mark pixels in the image as background and foreground 
         (particles). We blur the image with a Gaussian
         filter, and look for regions brighter than a global threshold 
-        level.'''
+        level. If a static background is given, it is subtracted first.
         
-        if self.sigma is not None:
-            blured = gaussian_filter(self.im, self.sigma)
-        else:
-            blured = self.im
+        window - None, or a tuple (r0, r1, c0, c1) of the image region to 
+                 process (used for the tiles); the binary image of this 
+                 region is returned.'''
+        
+        # the work buffers are not shared between tiles 
+        reuse = window is None
+        if window is None:
+            window = (0, self.im.shape[0], 0, self.im.shape[1])
+        r0, r1, c0, c1 = window
+        shape = (r1-r0, c1-c0)
+        
+        im = self.im[r0:r1, c0:c1]
+        mask = self.mask
+        if hasattr(mask, 'shape') and mask.shape == self.im.shape:
+            mask = mask[r0:r1, c0:c1]
+        
+        if self.background is not None:
+            out = self.get_buffer('foreground', shape, self.precision, reuse)
+            im = self.subtract_background(im, self.background[r0:r1, c0:c1],
+                                          out=out)
+        
+        filtered = self.get_buffer('filtered', shape, self.precision, reuse)
+        
+        if self.sigma is not None and self.loc_filter is not None:
+            local_mean = self.get_buffer('local_mean', shape, 
+                                         self.precision, reuse)
+            self.blur_and_remove_background(im, out=filtered, 
+                                            local_mean=local_mean)
+        
+        elif self.sigma is not None:
+            gaussian_filter(im, self.sigma, output=filtered)
             
-        if self.loc_filter is not None:
-            filtered = self.local_filter(blured)
+        elif self.loc_filter is not None:
+            local_mean = self.get_buffer('local_mean', shape, 
+                                         self.precision, reuse)
+            self.local_filter(im, out=filtered, local_mean=local_mean)
             
         else:
-            filtered = blured
-            
-        global_filt = filtered>self.th
-            
-        bin_image = 1.0 * global_filt * self.mask
+            filtered = im
+        
+        bin_image = self.get_buffer('binary', shape, bool, reuse)
+        greater(filtered, self.th, out=bin_image)
+        if hasattr(mask, 'shape'):
+            bin_image &= mask
+        elif mask != 1:
+            bin_image[...] = False
+        
+        # the margin of the crop around the ROI is set to background
+        R0, R1, C0, C1 = self.ROI_in_crop
+        R0, R1 = min(max(R0-r0, 0), r1-r0), min(max(R1-r0, 0), r1-r0)
+        C0, C1 = min(max(C0-c0, 0), c1-c0), min(max(C1-c0, 0), c1-c0)
+        bin_image[:R0,:], bin_image[R1:,:] = 0, 0
+        bin_image[:,:C0], bin_image[:,C1:] = 0, 0
         return bin_image 
     
 
@@ -74,14 +266,86 @@ class particle_segmentation(object):
     def blob_labeling(self, image):
         '''Will label connected areas (blobs) in a binary image and return
         these blobs coordinates. The values of image are 0 for background and
-        1 for foreground
+        1 for foreground. The labeling engine is chosen with the labeling 
+        attribute ('vectorized' or 'legacy'). 
+        
+        output - linked: a nested list of connected pixel indexes
+        '''
+        if self.labeling == 'vectorized':
+            return self.blob_labeling_vectorized(image)
+        
+        else:
+            return self.blob_labeling_legacy(image)
+    
+    
+    
+    def blob_labeling_vectorized(self, image):
+        '''Labels the 8-connected blobs of a binary image using 
+        scipy.ndimage.label, and returns the same list of blobs as 
+        blob_labeling_legacy() (see label_image()).
+        
+        output - linked: a list of (n,2) arrays of the blob pixel indexes
+        '''
+        labeled = self.label_image(image)
+        
+        # group the pixel indexes of each blob
+        pixels = flatnonzero(labeled)
+        pixel_labels = labeled.ravel()[pixels]
+        srt = argsort(pixel_labels, kind='stable')
+        pixels, pixel_labels = pixels[srt], pixel_labels[srt]
+        bounds = flatnonzero(pixel_labels[1:] != pixel_labels[:-1]) + 1
+        bounds = [0] + bounds.tolist() + [len(pixels)]
+        rows, cols = unravel_index(pixels, labeled.shape)
+        pixel_idx = column_stack([rows, cols])
+        linked = [pixel_idx[bounds[i]:bounds[i+1]] 
+                  for i in range(len(bounds)-1) if bounds[i+1]>bounds[i]]
+        
+        return linked
+    
+    
+    
+    def label_image(self, image):
+        '''Labels the 8-connected blobs of a binary image using 
+        scipy.ndimage.label. As in the legacy method, blobs that have no
+        pixels away from the image edges are ignored, and the blobs are 
+        ordered by their first pixel in the image (row by row).
+        
+        The label image is stored in the attribute self.labeled (0 for 
+        background and i+1 for the i-th blob) and returned.
+        '''
+        if image.dtype != bool:
+            image = image==1
+        labeled = self.get_buffer('labeled', image.shape, 'int32')
+        n = label(image, structure=ones((3,3)), output=labeled)
+        
+        # order the blobs by their first pixel in the image interior, and 
+        # drop the blobs found only on the image edges
+        interior = labeled[1:-1, 1:-1].ravel()
+        interior = interior[interior>0]
+        lbls, first = unique(interior, return_index=True)
+        lbls = lbls[argsort(first)]
+        
+        if len(lbls)<n or (lbls != arange(1, n+1)).any():
+            relabel = zeros(n+1, dtype=labeled.dtype)
+            relabel[lbls] = arange(1, len(lbls)+1)
+            relabel.take(labeled, out=labeled)
+        
+        self.labeled = labeled
+        self.N_blobs = len(lbls)
+        return labeled
+    
+    
+    
+    def blob_labeling_legacy(self, image):
+        '''The original pure Python labeling of connected areas (blobs) 
+        in a binary image using a breadth-first search over the pixels.
         
         output - linked: a nested list of connected pixel indexes
         '''
         
         nrow, ncol = image.shape
         
-        labeled = zeros((nrow, ncol))
+        labeled = zeros((nrow, ncol), dtype='int32')
         linked = []
         
         for i in range(1, nrow-1):
@@ -89,7 +353,7 @@ class particle_segmentation(object):
                 
                 if image[i,j]==1 and labeled[i,j]==0:                    
                     linked.append([(i,j)])
-                    labeled[i,j] = 1
+                    labeled[i,j] = len(linked)
                     que = [(i,j)]
                     
                     for pixel in que:
@@ -101,14 +365,16 @@ class particle_segmentation(object):
                                 if image[i2,j2]==1 and labeled[i2,j2]==0:
                                     que.append((i2,j2))
                                     linked[-1].append((i2,j2))
-                                    labeled[i2,j2]=1
-                        
+                                    labeled[i2,j2]=len(linked)
+        
+        self.labeled = labeled
+        self.N_blobs = len(linked)
         return linked
     
     
     
-    def get_blobs(self):
-        '''Returns a list of particle centers, their box size, and area
+    def get_blobs(self, size_filter=False):
+        '''Returns an array of particle centers, their box size, and area
         
         The center is the weighted mean of the blob coordinates using
         the brightness as weights.
@@ -116,80 +382,304 @@ class particle_segmentation(object):
         x and y directions.
         The area is the number of pixels belonging to the blob
         
-        returns - blobs: a nested list of [ [(center), (box size), area], ... ]
+        size_filter - if True, the blobs are filtered by their size and 
+                      area while their statistics are calculated (see 
+                      apply_blobs_size_filter), so the rejected blobs are
+                      never stored.
+        
+        returns - blobs: a structured array with the fields 
+                  (x, y, size_x, size_y, area), see blob_dtype
         '''
         
+        if self.tile_size is not None:
+            self.blobs = self.get_blobs_tiled(size_filter)
+            return
+        
         self.bin_im = self.get_binary_image() 
-        self.blob_pixels = self.blob_labeling(self.bin_im)
         
-        blobs = []
+        if self.labeling == 'vectorized':
+            self.label_image(self.bin_im)
+        else:
+            self.blob_labeling_legacy(self.bin_im)
         
-        for i in range(len(self.blob_pixels)):
-            
-            X = 0.0
-            Y = 0.0
-            tot = 0.0
-            
-            for x,y in self.blob_pixels[i]:
-                
-                if tot == 0.0:
-                    xmin, xmax = x, x
-                    ymin, ymax = y, y
-                else:
-                    if x<xmin: xmin=x
-                    if x>xmax: xmax=x
-                    if y<ymin: ymin=y
-                    if y>ymax: ymax=y
-                
-                bxy = self.im[x,y]
-                X += x*bxy
-                Y += y*bxy
-                tot += bxy
-            center = [round(X/tot, ndigits=2), round(Y/tot, ndigits=2)]
-            box_size = [xmax-xmin+1, ymax-ymin+1]
-            area = len(self.blob_pixels[i])
-            blobs.append( [center, box_size, area])
-            
-        self.blobs = blobs
+        self.blobs = self.blob_statistics(self.labeled, self.N_blobs, 
+                                          size_filter)
         
         
-    def apply_blobs_size_filter(self):
-        '''Will filter the list of blobs accoring to their bounding box size 
-        and their area.'''
+    def blob_statistics(self, labeled, n, size_filter=False):
+        '''Calculates the brightness weighted centers, the bounding box 
+        sizes and the areas of all the n blobs in a label image at once.
+        The centers are given in the full image coordinates (namely, shifted
+        by the offset of the ROI crop).
         
-        if self.bbox_limits[0] is not None:
-            fltr = lambda b: b[1][0] > self.bbox_limits[0]
-            self.blobs = list(filter(fltr, self.blobs))
+        returns - blobs: a structured array with n elements (see blob_dtype),
+                  or only the blobs that pass the size filter if size_filter
+                  is True
+        '''
+        if n==0:
+            self.size_filter_mask(zeros(0), zeros(0), zeros(0))
+            return empty(0, dtype=blob_dtype)
         
-        if self.bbox_limits[1] is not None:
-            fltr = lambda b: b[1][0] < self.bbox_limits[1]
-            self.blobs = list(filter(fltr, self.blobs))
+        pixels = flatnonzero(labeled)
+        lbls = labeled.ravel()[pixels].astype(intp)
+        x, y = unravel_index(pixels, labeled.shape)
+        w = self.im.ravel()[pixels].astype('f8')
         
-        if self.bbox_limits[2] is not None:
-            fltr = lambda b: b[1][1] > self.bbox_limits[2]
-            self.blobs = list(filter(fltr, self.blobs))
+        tot = bincount(lbls, weights=w, minlength=n+1)[1:]
+        X = bincount(lbls, weights=x*w, minlength=n+1)[1:]
+        Y = bincount(lbls, weights=y*w, minlength=n+1)[1:]
+        area = bincount(lbls, minlength=n+1)[1:]
         
-        if self.bbox_limits[3] is not None:
-            fltr = lambda b: b[1][1] < self.bbox_limits[3]
-            self.blobs = list(filter(fltr, self.blobs))
-            
-        if self.area_limits[0] is not None:
-            fltr = lambda b: b[2] > self.area_limits[0]
+        # the bounding boxes are found from the pixels sorted by label
+        srt = argsort(lbls, kind='stable')
+        starts = concatenate([[0], cumsum(area)[:-1]])
+        x, y = x[srt], y[srt]
         
-        if self.area_limits[1] is not None:
-            fltr = lambda b: b[2] < self.area_limits[1]
+        size_x = maximum.reduceat(x, starts) - minimum.reduceat(x, starts) + 1
+        size_y = maximum.reduceat(y, starts) - minimum.reduceat(y, starts) + 1
+        return self.make_blobs(tot, X, Y, size_x, size_y, area, size_filter)
+    
+    
+    def make_blobs(self, tot, X, Y, size_x, size_y, area, size_filter=False):
+        '''Returns the blobs array from the blob sums of the brightness 
+        (tot) and the brightness weighted coordinates (X, Y), and from the 
+        blob sizes. If size_filter is True, only the blobs that pass the size
+        filter are put in the array.'''
+        keep = self.size_filter_mask(size_x, size_y, area)
+        if not size_filter:
+            keep[:] = True
+        
+        blobs = empty(keep.sum(), dtype=blob_dtype)
+        tot = tot[keep]
+        blobs['x'] = npround(X[keep]/tot + self.offset[0], 2)
+        blobs['y'] = npround(Y[keep]/tot + self.offset[1], 2)
+        blobs['size_x'] = size_x[keep]
+        blobs['size_y'] = size_y[keep]
+        blobs['area'] = area[keep]
+        return blobs
+        
+        
+    def get_tiles(self):
+        '''Returns a list of the tiles, (r0, r1, c0, c1), that cover the 
+        image, row by row.'''
+        nrow, ncol = self.im.shape
+        t = int(self.tile_size)
+        return [(r0, min(r0+t, nrow), c0, min(c0+t, ncol)) 
+                for r0 in range(0, nrow, t) for c0 in range(0, ncol, t)]
+    
+    
+    def segment_tile(self, tile):
+        '''
+        Segments a tile (r0, r1, c0, c1) of the image. The tile is filtered
+        together with a margin as wide as the filters, and its blobs are
+        labeled inside the tile only. 
+        
+        Returns a dictionary with the label image edges (for merging blobs
+        across tiles), and with the sums, extents and first interior pixel
+        of each of the tile's blobs, in the image coordinates. 
+        '''
+        nrow, ncol = self.im.shape
+        r0, r1, c0, c1 = tile
+        h = self.get_filters_margin()
+        rr0, rr1 = max(0, r0-h), min(nrow, r1+h)
+        cc0, cc1 = max(0, c0-h), min(ncol, c1+h)
+        
+        bin_im = self.get_binary_image((rr0, rr1, cc0, cc1))
+        bin_im = bin_im[r0-rr0:r1-rr0, c0-cc0:c1-cc0]
+        labeled, n = label(bin_im, structure=ones((3,3)))
+        
+        pixels = flatnonzero(labeled)
+        lbls = labeled.ravel()[pixels]
+        x, y = unravel_index(pixels, labeled.shape)
+        x, y = x + r0, y + c0
+        w = self.im[x, y].astype('f8')
+        
+        # pixels on the image edges are not used to order the blobs
+        big = nrow * ncol
+        interior = (x>0) & (x<nrow-1) & (y>0) & (y<ncol-1)
+        first = x*ncol + y
+        first[~interior] = big
+        
+        area = bincount(lbls, minlength=n+1)[1:]
+        starts = concatenate([[0], cumsum(area)[:-1]]).astype(intp)
+        srt = argsort(lbls, kind='stable')
+        xs, ys, fs = x[srt], y[srt], first[srt]
+        
+        if n == 0:
+            xs = ys = fs = zeros(1, dtype=intp)
+            starts = zeros(0, dtype=intp)
+        
+        res = {'n': n,
+               'tot': bincount(lbls, weights=w, minlength=n+1)[1:],
+               'X': bincount(lbls, weights=x*w, minlength=n+1)[1:],
+               'Y': bincount(lbls, weights=y*w, minlength=n+1)[1:],
+               'area': area,
+               'xmin': minimum.reduceat(xs, starts),
+               'xmax': maximum.reduceat(xs, starts),
+               'ymin': minimum.reduceat(ys, starts),
+               'ymax': maximum.reduceat(ys, starts),
+               'first': minimum.reduceat(fs, starts),
+               'edges': (labeled[0,:].copy(), labeled[-1,:].copy(), 
+                         labeled[:,0].copy(), labeled[:,-1].copy())}
+        return res
+    
+    
+    def get_blobs_tiled(self, size_filter=False):
+        '''
+        Segments the image tile by tile (using n_threads threads), merges 
+        the blobs that cross the tile boundaries, and returns the blobs 
+        array, with the same blobs and order as the untiled segmentation.
+        If size_filter is True, only the blobs that pass the size filter are
+        returned.
+        '''
+        from numpy import full, inf
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        
+        tiles = self.get_tiles()
+        if self.n_threads is not None and self.n_threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+                results = list(pool.map(self.segment_tile, tiles))
+        else:
+            results = [self.segment_tile(tile) for tile in tiles]
+        
+        # give the blobs of each tile global labels (0 is the background)
+        offsets = cumsum([0] + [res['n'] for res in results])
+        N = offsets[-1]
+        glob = lambda lbl, off: lbl + (lbl>0) * off
+        
+        # the label image edges of the tiles are assembled into the rows
+        # and columns of the seams between the tiles
+        nrow, ncol = self.im.shape
+        row_seams, col_seams = {}, {}
+        for tile, res, off in zip(tiles, results, offsets):
+            r0, r1, c0, c1 = tile
+            top, bottom, left, right = [glob(e, off) for e in res['edges']]
+            for r, e, side in [(r0, top, 1), (r1, bottom, 0)]:
+                if 0 < r < nrow:
+                    seam = row_seams.setdefault(r, zeros((2, ncol), intp))
+                    seam[side, c0:c1] = e
+            for c, e, side in [(c0, left, 1), (c1, right, 0)]:
+                if 0 < c < ncol:
+                    seam = col_seams.setdefault(c, zeros((2, nrow), intp))
+                    seam[side, r0:r1] = e
+        
+        # pairs of labels of 8-connected pixels across the seams
+        pairs_i, pairs_j = [], []
+        for seam in list(row_seams.values()) + list(col_seams.values()):
+            a, b = seam
+            L = len(a)
+            for d in [-1, 0, 1]:
+                aa = a[max(0, -d):L-max(0, d)]
+                bb = b[max(0, d):L-max(0, -d)]
+                touch = (aa>0) & (bb>0)
+                pairs_i.append(aa[touch])
+                pairs_j.append(bb[touch])
+        
+        pairs_i = concatenate(pairs_i + [zeros(0, intp)])
+        pairs_j = concatenate(pairs_j + [zeros(0, intp)])
+        graph = coo_matrix((ones(len(pairs_i)), (pairs_i, pairs_j)),
+                           shape=(N+1, N+1))
+        n_comp, comp = connected_components(graph, directed=False)
+        comp = comp[1:]
+        
+        # merge the statistics of the connected tile blobs
+        cat = lambda key: concatenate([res[key] for res in results] + 
+                                      [zeros(0)])
+        sums = {}
+        for key in ['tot', 'X', 'Y', 'area']:
+            sums[key] = bincount(comp, weights=cat(key), minlength=n_comp)
+        ext = {}
+        for key, func, init in [('xmin', minimum, inf), ('xmax', maximum, -1),
+                                ('ymin', minimum, inf), ('ymax', maximum, -1),
+                                ('first', minimum, inf)]:
+            ext[key] = full(n_comp, init, dtype='f8')
+            func.at(ext[key], comp, cat(key))
+        
+        # blobs without interior pixels are dropped, and the rest are 
+        # ordered by their first interior pixel
+        keep = flatnonzero(ext['first'] < nrow*ncol)
+        keep = keep[argsort(ext['first'][keep], kind='stable')]
+        
+        self.N_blobs = len(keep)
+        
+        size_x = (ext['xmax'][keep] - ext['xmin'][keep] + 1).astype('i8')
+        size_y = (ext['ymax'][keep] - ext['ymin'][keep] + 1).astype('i8')
+        area = sums['area'][keep].astype('i8')
+        return self.make_blobs(sums['tot'][keep], sums['X'][keep], 
+                               sums['Y'][keep], size_x, size_y, area,
+                               size_filter)
+        
+        
+    def size_filter_mask(self, size_x, size_y, area):
+        '''
+        Returns a boolean mask of the blobs, given by their bounding box 
+        sizes and areas, that pass all the size criteria (the limits are 
+        exclusive). The number of blobs rejected by each criterion is stored
+        in the dictionary self.rejected (a blob that fails several criteria
+        is counted in each of them).
+        '''
+        limits = self.bbox_limits + self.area_limits
+        props = [size_x, size_x, size_y, size_y, area, area]
+        
+        keep = ones(len(area), dtype=bool)
+        self.rejected = {}
+        for crit, lim, prop in zip(size_criteria, limits, props):
+            if lim is None:
+                self.rejected[crit] = 0
+                continue
+            if crit.startswith('min'):
+                passed = prop > lim
+            else:
+                passed = prop < lim
+            self.rejected[crit] = int(len(passed) - passed.sum())
+            keep &= passed
+        return keep
+    
+    
+    def apply_blobs_size_filter(self):
+        '''Will filter the list of blobs accoring to their bounding box size 
+        and their area. The number of blobs rejected by each criterion is
+        stored in self.rejected.'''
+        b = self.blobs
+        self.blobs = b[self.size_filter_mask(b['size_x'], b['size_y'], 
+                                             b['area'])]
             
             
     def plot_blobs(self, vmin=None, vmax=None):
         import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
-        ax.imshow(self.im, vmin=vmin, vmax=vmax)
+        ax.imshow(self.full_im, vmin=vmin, vmax=vmax)
         
-        for blb in self.blobs:
-            
-            ax.errorbar( [blb[0][1]], [blb[0][0]], 
-                        xerr=blb[1][1]/2, yerr=blb[1][0]/2,
-                        fmt='xr', lw=0.7, capsize=2)
+        ax.errorbar(self.blobs['y'], self.blobs['x'], 
+                    xerr=self.blobs['size_y']/2, yerr=self.blobs['size_x']/2,
+                    fmt='xr', ls='none', lw=0.7, capsize=2)
+        
+        
+    def blobs_as_rows(self, frame, out=None):
+        '''
+        Returns the blobs as a (n,6) array with the columns of the blob 
+        files, namely
+        center_x, center_y, size_x, size_y, area, frame_number
+        
+        out - None, or an array with 6 columns and at least n rows; the 
+              blobs are written into its first n rows, and this part of 
+              out is returned.
+        '''
+        b = self.blobs
+        if out is None:
+            return column_stack([b['x'], b['y'], b['size_x'], b['size_y'], 
+                                 b['area'], zeros(len(b)) + frame])
+        
+        if len(out) < len(b):
+            msg = 'out has room for %d blobs, but %d were found.'
+            raise ValueError(msg%(len(out), len(b)))
+        rows = out[:len(b)]
+        for i, field in enumerate(['x', 'y', 'size_x', 'size_y', 'area']):
+            rows[:,i] = b[field]
+        rows[:,5] = frame
+        return rows
         
         
     def save_results(self, fname):
@@ -197,13 +687,8 @@ class particle_segmentation(object):
         This is used to save the blobs found in a text file with 
         the given name fname.
         '''
-        blob_list = []
-        for blb in self.blobs:
-            blob_list.append([blb[0][0], blb[0][1], blb[1][0], blb[1][1],
-                              blb[2], 0])
-            
-        savetxt(fname, blob_list, 
-                fmt=['%.02f','%.02f','%d','%d','%d','%d'], delimiter='\t')
+        blob_list = self.blobs_as_rows(0)
+        savetxt(fname, blob_list, fmt=blob_file_fmt, delimiter='\t')
         
         
         
@@ -212,6 +697,72 @@ class particle_segmentation(object):
         
         
         
+class segmentation_workspace(object):
+    '''
+    A workspace for segmenting a sequence of frames of one shape and dtype.
+    The workspace owns the work arrays of the segmentation (the filtered 
+    image, the local mean, the binary image and the label image), which are
+    allocated once and filled in place for every frame.
+    '''
+    
+    def __init__(self, shape, dtype, **seg_params):
+        '''
+        shape, dtype - the shape and dtype of the frames
+        
+        seg_params - the keyword arguments of particle_segmentation (without
+                     the image and the buffers).
+        '''
+        from numpy import dtype as np_dtype
+        self.shape = tuple(shape)
+        self.dtype = np_dtype(dtype)
+        self.seg_params = seg_params
+        self.buffers = {}
+        
+        # the work arrays are allocated by segmenting an empty frame
+        self.segment(zeros(self.shape, dtype=self.dtype))
+        
+        
+    def segment(self, image, frame=0, out=None):
+        '''
+        Segments a frame using the work arrays of the workspace. The 
+        particle_segmentation object of the last frame is kept in 
+        self.segmentation.
+        
+        image - the frame, with the shape and dtype of the workspace
+        frame - the frame number written in the blob rows
+        out - None, or an array with 6 columns into which the blob rows are
+              written (see particle_segmentation.blobs_as_rows)
+        
+        returns - rows, rejected: the blobs that pass the size filter in the
+                  blob file layout, and a dictionary with the number of 
+                  blobs rejected by each of the size criteria.
+        '''
+        if image.shape != self.shape or image.dtype != self.dtype:
+            msg = 'the frame (%s, %s) does not match the workspace (%s, %s).'
+            raise ValueError(msg%(image.shape, image.dtype, 
+                                  self.shape, self.dtype))
+        
+        ps = particle_segmentation(image, buffers=self.buffers, 
+                                   **self.seg_params)
+        ps.get_blobs(size_filter=True)
+        self.segmentation = ps
+        return ps.blobs_as_rows(frame, out=out), ps.rejected
+    
+    
+    
+    
+def get_workspace(workspaces, image, seg_params):
+    '''Returns the segmentation_workspace for the shape and dtype of the 
+    image from the dictionary workspaces, creating it if needed.'''
+    key = (image.shape, image.dtype.str)
+    if key not in workspaces:
+        workspaces[key] = segmentation_workspace(image.shape, image.dtype,
+                                                 **seg_params)
+    return workspaces[key]
+        
+        
+        
+        
 class loop_segmentation(object):
     
     '''A class for looping over images in a library to segment particles
@@ -221,16 +772,49 @@ class loop_segmentation(object):
                  sigma=1.0, threshold=10, mask=1.0, local_filter = 15,
                  min_xsize=None, max_xsize=None,
                  min_ysize=None, max_ysize=None,
-                 min_area=None, max_area=None):
+                 min_area=None, max_area=None, labeling='vectorized',
+                 n_workers=1, background=None, ROI=None, tile_size=None,
+                 n_threads=1, prefetch=2, precision='float32'):
         '''
         dir_name - string with the name of the directory that holds the 
                    images. Images should have a sequential numbers in their
-                   file names. 
+                   file names. Alternatively, this can be an image source
+                   object (image_folder, tiff_image_stack or 
+                   raw_image_stack) that gives the frames to segment.
         extension - the extension of the images
         
         N_img -     if None, then this will loop over all the images in the 
                     folder. If it is an integer, will loop over the first
                     N images in the folder.
+        
+        labeling - the engine used to label connected blobs, either 
+                   'vectorized' (default, uses scipy.ndimage) or 'legacy' 
+                   (the original pure Python labeling).
+        
+        n_workers - the number of processes used to segment the images. If
+                    1 (default), the images are segmented serially in this
+                    process. 
+        
+        prefetch - when segmenting serially, the number of images that are
+                   read ahead in a background thread while the current 
+                   image is segmented (0 reads each image when it is 
+                   needed).
+        
+        background - None, or an array with a static background that is 
+                     subtracted from every frame (see temporal_background).
+        
+        ROI - None, or a region of interest (xmin, xmax, ymin, ymax) to 
+              which the frames are cropped before the segmentation (see 
+              particle_segmentation).
+        
+        tile_size, n_threads - segment each frame in tiles of this size
+                               over n_threads threads (see 
+                               particle_segmentation).
+        
+        precision - the floating point type of the filtered images (see 
+                    particle_segmentation). The work arrays of the 
+                    segmentation are allocated once and reused for all 
+                    the frames (see segmentation_workspace).
                     
         The rest are parameters for the segmentation class. 
         '''
@@ -243,50 +827,84 @@ class loop_segmentation(object):
         self.bbox_limits = (min_xsize, max_xsize, min_ysize, max_ysize)
         self.area_limits = (min_area, max_area)
         self.loc_filter = local_filter
+        self.labeling = labeling
+        self.n_workers = n_workers
+        self.background = background
+        self.ROI = ROI
+        self.tile_size = tile_size
+        self.n_threads = n_threads
+        self.prefetch = prefetch
+        self.precision = precision
+    
+    
+    def get_segmentation_params(self):
+        '''
+        Returns a dictionary with the keyword arguments used to initiate the
+        particle_segmentation objects of each frame.
+        '''
+        # the mask is turned into a boolean array once for all the frames
+        mask = self.mask
+        if hasattr(mask, 'shape') and mask.dtype != bool:
+            mask = mask == 1
+        
+        return dict(sigma=self.sigma, 
+                    threshold=self.th,
+                    local_filter=self.loc_filter,
+                    mask=mask,
+                    max_xsize=self.bbox_limits[1],
+                    min_xsize=self.bbox_limits[0],
+                    max_ysize=self.bbox_limits[3],
+                    min_ysize=self.bbox_limits[2],
+                    min_area=self.area_limits[0],
+                    max_area=self.area_limits[1],
+                    labeling=self.labeling,
+                    background=self.background,
+                    ROI=self.ROI,
+                    tile_size=self.tile_size,
+                    n_threads=self.n_threads,
+                    precision=self.precision)
     
     
     def get_file_names(self):
-        import os
-        allfiles = os.listdir(self.dir_name)
-        n_ext = len(self.extension)
-        fltr = lambda s: s[-n_ext:]==self.extension
-        image_files = sorted(list(filter(fltr, allfiles)))
-        self.image_files = image_files
+        self.image_files = image_folder(self.dir_name, 
+                                        self.extension).image_files
     
     
-    def segment_folder_images(self):
-        '''This loops over the image files in a folder'''
-        import os
+    def get_image_source(self):
+        '''Returns the image source object that gives the frames.'''
+        if type(self.dir_name) == str:
+            return image_folder(self.dir_name, self.extension)
+        else:
+            return self.dir_name
+    
+    
+    def segment_folder_images(self, stream_fname=None, resume=False):
+        '''This loops over the image files in a folder. If n_workers is 
+        larger than 1, the frames are spread over a pool of processes and 
+        the results are reassembled in the frame order.
         
-        self.get_file_names()
+        stream_fname - if None (default), the blobs are kept in self.blobs.
+                       If a file name is given, the blobs of each frame are 
+                       appended to this blob file as soon as they are found, 
+                       together with a frame index file (see 
+                       blob_file_writer), and are not kept in memory.
         
-        if self.N_img is None: 
-            N = len(self.image_files)
-        else:
-            N = self.N_img
+        resume - if True, the frames already found in the frame index of 
+                 stream_fname (from an earlier run that was interrupted, or
+                 before new images were added to the folder) are skipped, 
+                 and the blobs of the other frames are appended to the 
+                 file (see resume_blob_file).
+        '''
+        if resume and stream_fname is None:
+            raise ValueError('resuming a segmentation needs a stream_fname.')
         
-        blob_list = []
-        print('Starting loop segmentation.')
-        for i in range(N):
-            print('', end='\r')
-            print(' frame: %d'%i, end='\r')
-            im = imread(os.path.join(self.dir_name, self.image_files[i]))
-            ps = particle_segmentation(im, sigma=self.sigma, 
-                                       threshold=self.th,
-                                       local_filter=self.loc_filter,
-                                       mask=self.mask,
-                                       max_xsize=self.bbox_limits[1],
-                                       min_xsize=self.bbox_limits[0],
-                                       max_ysize=self.bbox_limits[3],
-                                       min_ysize=self.bbox_limits[2],
-                                       min_area=self.area_limits[0],
-                                       max_area=self.area_limits[1])
-            ps.get_blobs()
-            ps.apply_blobs_size_filter()
-            for blb in ps.blobs:
-                blob_list.append([blb[0][0], blb[0][1], blb[1][0], blb[1][1],
-                                  blb[2], i])
-        self.blobs = blob_list
+        # the loop is run as a multi-camera segmentation of one camera, 
+        # which sets self.blobs, self.N_blobs and self.rejected
+        mcs = multi_camera_segmentation([self], [stream_fname], 
+                                        n_workers=self.n_workers, 
+                                        prefetch=self.prefetch)
+        mcs.segment_images(resume=resume)
+        self.timing = mcs.timing
         
                                        
     def save_results(self, fname):
@@ -296,13 +914,756 @@ class loop_segmentation(object):
         The format of the results is
         center_x, center_y, size_x, size_y, area, frame_number
         '''
-        savetxt(fname, self.blobs, 
-                fmt=['%.02f','%.02f','%d','%d','%d','%d'], delimiter='\t')
+        savetxt(fname, self.blobs, fmt=blob_file_fmt, delimiter='\t')
+
+
+
+
+class multi_camera_segmentation(object):
+    '''
+    Segments the images of several cameras in one pass. The frames of all
+    the cameras are interleaved (frame 0 of every camera, then frame 1, 
+    etc.) over one shared pool of worker processes, and the blobs of each
+    camera are written to its own blob file as they are found, so the 
+    throughput depends on the number of cores and the disk rather than on
+    the number of cameras.
+    '''
+    
+    def __init__(self, segmentations, save_names=None, n_workers=1, 
+                 prefetch=2):
+        '''
+        segmentations - a list of loop_segmentation objects, one per camera,
+                        holding the image source and the segmentation 
+                        parameters of each camera.
+        
+        save_names - None, or a list with a blob file name for each camera
+                     (None for a camera whose blobs are not saved). The 
+                     blobs of cameras that are not saved are kept in the 
+                     blobs attribute of their loop_segmentation object.
+        
+        n_workers - the number of processes in the shared pool. If 1, the
+                    frames are segmented in the main process, while the 
+                    next images are read ahead in a background thread.
+        
+        prefetch - the number of images read ahead when n_workers is 1.
+        '''
+        self.segmentations = segmentations
+        if save_names is None:
+            save_names = [None for seg in segmentations]
+        if len(save_names) != len(segmentations):
+            raise ValueError('a save name is needed for each camera.')
+        self.save_names = save_names
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+        
         
+    def get_tasks(self, N_frames):
+        '''Returns the list of (camera, frame) pairs to segment, frame by
+        frame, for cameras with N_frames[camera] frames.'''
+        return [(cam, i) for i in range(max(N_frames + [0])) 
+                for cam in range(len(N_frames)) if i < N_frames[cam]]
         
         
+    def segment_images(self, resume=False):
+        '''
+        Segments the images of all the cameras. The blobs that are not 
+        saved to a file, the total number of blobs and the number of blobs 
+        rejected by each size criterion in each frame (a dictionary, 
+        criterion -> array of counts per frame) are stored in the blobs, 
+        N_blobs and rejected attributes of the loop_segmentation object of
+        each camera, and the time spent on reading and segmenting images in
+        self.timing (see timing_keys).
+        
+        resume - if True, the frames already found in the blob file of each
+                 camera are skipped, and the blobs of the other frames are 
+                 appended to it (see resume_blob_file).
+        '''
+        sources = [seg.get_image_source() for seg in self.segmentations]
+        seg_params = [seg.get_segmentation_params() 
+                      for seg in self.segmentations]
+        N_frames = []
+        for seg, source in zip(self.segmentations, sources):
+            N_frames.append(len(source) if seg.N_img is None else seg.N_img)
+        
+        writers, blob_lists, done = [], [], []
+        for seg, fname in zip(self.segmentations, self.save_names):
+            if fname is None:
+                writers.append(None)
+                done.append(set())
+            elif resume:
+                writer, done_cam = resume_blob_file(fname)
+                writers.append(writer)
+                done.append(done_cam)
+            else:
+                writers.append(blob_file_writer(fname))
+                done.append(set())
+            blob_lists.append([])
+            seg.N_blobs = 0
+            seg.rejected = dict([(crit, []) for crit in size_criteria])
+        
+        tasks = [(cam, i) for cam, i in self.get_tasks(N_frames) 
+                 if i not in done[cam]]
+        
+        if len(self.segmentations) == 1:
+            print('Starting loop segmentation.')
+        else:
+            print('Starting multi-camera segmentation.')
+        if resume:
+            N_done = sum([len(d) for d in done])
+            print('%d frames were already segmented.'%N_done)
+        self.timing = dict([(key, 0.0) for key in timing_keys])
+        t0 = perf_counter()
+        if self.n_workers is None or self.n_workers <= 1:
+            images = image_prefetcher(lambda task: sources[task[0]][task[1]], 
+                                      tasks, depth=self.prefetch)
+            workspaces = [{} for seg in self.segmentations]
+            results = segment_timed(images, [i for cam, i in tasks], 
+                                    [seg_params[cam] for cam, i in tasks],
+                                    self.timing,
+                                    [workspaces[cam] for cam, i in tasks])
+            self.collect_results(tasks, results, writers, blob_lists)
+            self.timing['read'] = images.read_time
+            self.timing['io_wait'] = images.wait_time
+        
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            
+            # each worker reads its own images, so the reading of images 
+            # overlaps with the segmentation in the other workers
+            with ProcessPoolExecutor(max_workers=self.n_workers,
+                                     initializer=init_segmentation_worker,
+                                     initargs=(seg_params, sources)) as pool:
+                results = ordered_pool_map(pool, 
+                                           segment_camera_frame_worker, 
+                                           tasks, 4*self.n_workers)
+                results = strip_timing(results, self.timing)
+                self.collect_results(tasks, results, writers, blob_lists)
+        self.timing['total'] = perf_counter() - t0
+        
+        for seg, writer, blob_list in zip(self.segmentations, writers, 
+                                          blob_lists):
+            for crit in size_criteria:
+                seg.rejected[crit] = array(seg.rejected[crit], dtype=int)
+            if writer is not None:
+                writer.close()
+                seg.blobs = None
+            elif len(blob_list)>0:
+                seg.blobs = concatenate(blob_list)
+            else:
+                seg.blobs = zeros((0,6))
+    
+    
+    def collect_results(self, tasks, results, writers, blob_lists):
+        '''Sends the blobs of each (camera, frame) task to the writer or 
+        the blob list of its camera, in the order of the tasks.'''
+        for (cam, i), (blobs, rejected) in zip(tasks, results):
+            print('', end='\r')
+            print(' frame: %d'%i, end='\r')
+            seg = self.segmentations[cam]
+            seg.N_blobs += len(blobs)
+            for crit in size_criteria:
+                seg.rejected[crit].append(rejected[crit])
+            if writers[cam] is None:
+                blob_lists[cam].append(blobs)
+            else:
+                writers[cam].write_frame(i, blobs)
+
+
+
+
+class blob_file_writer(object):
+    '''
+    Writes blobs to a blob file one frame at a time, so the results are
+    on the disk as soon as each frame is segmented. 
+    
+    Next to the blob file we keep a frame index file (the blob file name 
+    with an added '.idx' extension) with a line for every frame written:
+    frame_number, byte_offset, number_of_blobs 
+    so that the blobs of a given frame can be read without reading the
+    whole file (see read_blob_file_frame).
+    '''
+    
+    def __init__(self, fname, append=False):
+        '''
+        fname - string, the path of the blob file
+        append - if False (default), existing files are overwritten. If 
+                 True, the new frames are appended to the existing files.
+        '''
+        self.fname = fname
+        self.index_fname = fname + '.idx'
+        mode = 'ab' if append else 'wb'
+        self.f = open(self.fname, mode)
+        self.f_index = open(self.index_fname, mode)
+        
+        
+    def write_frame(self, frame, blobs):
+        '''
+        Appends the blobs of a frame, given as an array in the blob file 
+        layout, and adds the frame to the index file. Both files are flushed
+        so the frame is kept if the run crashes.
+        '''
+        offset = self.f.tell()
+        savetxt(self.f, blobs, fmt=blob_file_fmt, delimiter='\t')
+        self.f.flush()
+        line = '%d\t%d\t%d\n'%(frame, offset, len(blobs))
+        self.f_index.write(line.encode())
+        self.f_index.flush()
+        
+        
+    def close(self):
+        self.f.close()
+        self.f_index.close()
+
+
+
+
+def read_blob_file_index(fname):
+    '''
+    Reads the frame index file of a blob file that was written by 
+    blob_file_writer, and returns a dictionary whose keys are frame 
+    numbers and values are tuples (byte_offset, number_of_blobs).
+    '''
+    index = {}
+    with open(fname + '.idx', 'r') as f:
+        for ln in f:
+            frame, offset, n = [int(val) for val in ln.split()]
+            index[frame] = (offset, n)
+    return index
+
+
+def recover_blob_file(fname):
+    '''
+    Brings a blob file written by blob_file_writer back to the state after
+    its last completed frame, so new frames can be appended to it after an
+    interrupted run. A line of the frame index file that was not completely
+    written is dropped, and the blob file is truncated after the blobs of 
+    the last frame in the index (removing the blobs of a frame that was not
+    completed).
+    
+    returns - the frame index of the completed frames (as in 
+              read_blob_file_index)
+    '''
+    import os
+    
+    index, index_end, last = {}, 0, None
+    with open(fname + '.idx', 'rb') as f:
+        for ln in f:
+            vals = ln.split()
+            if not ln.endswith(b'\n') or len(vals) != 3:
+                break
+            frame, offset, n = [int(val) for val in vals]
+            index[frame] = (offset, n)
+            index_end += len(ln)
+            last = (offset, n)
+    
+    # the end of the blobs of the last completed frame
+    end = 0
+    if last is not None:
+        with open(fname, 'rb') as f:
+            f.seek(last[0])
+            for i in range(last[1]):
+                f.readline()
+            end = f.tell()
+    
+    os.truncate(fname + '.idx', index_end)
+    os.truncate(fname, end)
+    return index
+
+
+def resume_blob_file(fname):
+    '''
+    Opens a blob file for appending the frames that are not in it yet. If
+    the blob file and its frame index exist, the file is recovered from an
+    interrupted run (see recover_blob_file); if neither exists, a new file
+    is started.
+    
+    returns - writer, done: a blob_file_writer that appends to the file, and
+              the set of frame numbers that are already in the file
+    '''
+    import os
     
+    if os.path.exists(fname + '.idx'):
+        done = set(recover_blob_file(fname).keys())
+        return blob_file_writer(fname, append=True), done
     
+    if os.path.exists(fname):
+        msg = 'the blob file %s has no frame index, so it cannot be resumed.'
+        raise ValueError(msg%fname)
+    return blob_file_writer(fname), set()
 
 
+def read_blob_file_frame(fname, frame, index=None):
+    '''
+    Reads the blobs of a single frame from a blob file, seeking directly to
+    the frame using the frame index file. Returns an (n,6) array in the blob
+    file layout.
+    
+    index - the output of read_blob_file_index(fname); if None, the index 
+            file is read here.
+    '''
+    if index is None:
+        index = read_blob_file_index(fname)
+    
+    offset, n = index[frame]
+    blobs = zeros((n, 6))
+    with open(fname, 'rb') as f:
+        f.seek(offset)
+        for i in range(n):
+            blobs[i,:] = [float(val) for val in f.readline().split()]
+    return blobs
+
 
+
+
+class image_folder(object):
+    '''
+    An image source for a folder with one image file per frame. The frames
+    are the image files sorted by their names.
+    
+    Image sources are used by loop_segmentation to get the frames; they 
+    have a length (the number of frames) and are indexed by the frame 
+    number.
+    '''
+    
+    def __init__(self, dir_name, extension='.tif'):
+        '''
+        dir_name - string, the path of the folder with the images
+        extension - the extension of the image files
+        '''
+        import os
+        self.dir_name = dir_name
+        self.extension = extension
+        allfiles = os.listdir(self.dir_name)
+        n_ext = len(self.extension)
+        fltr = lambda s: s[-n_ext:]==self.extension
+        self.image_files = sorted(list(filter(fltr, allfiles)))
+        
+        
+    def __len__(self):
+        return len(self.image_files)
+    
+    
+    def __getitem__(self, i):
+        import os
+        return imread(os.path.join(self.dir_name, self.image_files[i]))
+    
+    
+    
+    
+class raw_image_stack(object):
+    '''
+    An image source for a raw binary file holding consecutive uncompressed
+    frames. The file is memory-mapped, and each frame is a view into the
+    map, so only the pages of the frames being used are read from the disk.
+    '''
+    
+    def __init__(self, fname, frame_shape, dtype='uint8', offset=0, 
+                 N_frames=None):
+        '''
+        fname - string, the path of the raw file
+        frame_shape - tuple (2), the number of rows and columns of a frame
+        dtype - the data type of the pixels
+        offset - the number of bytes before the first frame (a header)
+        N_frames - the number of frames in the file; if None, this is 
+                   deduced from the file size.
+        '''
+        import os
+        from numpy import dtype as npdtype
+        self.fname = fname
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = npdtype(dtype)
+        self.offset = offset
+        
+        if N_frames is None:
+            frame_bytes = self.dtype.itemsize * self.frame_shape[0] * \
+                          self.frame_shape[1]
+            N_frames = (os.path.getsize(fname) - offset) // frame_bytes
+        self.N_frames = N_frames
+        self.stack = None
+        self.pid = None
+        
+        
+    def open(self):
+        '''Memory-maps the file (done on the first frame access in each 
+        process).'''
+        import os
+        from numpy import memmap
+        shape = (self.N_frames,) + self.frame_shape
+        self.stack = memmap(self.fname, dtype=self.dtype, mode='r', 
+                            offset=self.offset, shape=shape)
+        self.pid = os.getpid()
+        
+        
+    def __len__(self):
+        return self.N_frames
+    
+    
+    def __getitem__(self, i):
+        import os
+        if self.pid != os.getpid():
+            self.open()
+        return self.stack[i]
+    
+    
+    def __getstate__(self):
+        # the memory map is not sent to other processes; they open their own
+        state = self.__dict__.copy()
+        state['stack'] = None
+        state['pid'] = None
+        return state
+    
+    
+    
+    
+class tiff_image_stack(object):
+    '''
+    An image source for a multi-page TIFF file, one page per frame. If the
+    pages are uncompressed and stored contiguously, the file is memory-mapped
+    and each frame is a view into the map. Otherwise, only the page of the 
+    requested frame is read and decoded. This requires the tifffile package.
+    '''
+    
+    def __init__(self, fname):
+        '''
+        fname - string, the path of the TIFF file
+        '''
+        self.fname = fname
+        self.tif = None
+        self.stack = None
+        self.open()
+        
+        
+    def open(self):
+        '''Opens the file, and memory-maps it if possible. Each process
+        opens the file separately.'''
+        import os
+        from tifffile import TiffFile, memmap
+        self.pid = os.getpid()
+        self.tif = TiffFile(self.fname)
+        self.N_frames = len(self.tif.pages)
+        try:
+            stack = memmap(self.fname, mode='r')
+            if stack.ndim == 2:
+                stack = stack.reshape((1,) + stack.shape)
+            if stack.shape[0] == self.N_frames:
+                self.stack = stack
+        except ValueError:
+            self.stack = None
+        
+        
+    def __len__(self):
+        return self.N_frames
+    
+    
+    def __getitem__(self, i):
+        import os
+        if self.pid != os.getpid():
+            self.open()
+        if self.stack is not None:
+            return self.stack[i]
+        return self.tif.pages[i].asarray()
+    
+    
+    def __getstate__(self):
+        # the open file is not sent to other processes; they open their own
+        state = self.__dict__.copy()
+        state['tif'] = None
+        state['stack'] = None
+        state['pid'] = None
+        return state
+
+
+
+
+class temporal_background(object):
+    '''
+    A static background for an image sequence, calculated once as the 
+    per-pixel minimum, mean or median of a subset of frames sampled evenly
+    over the sequence. The frames are read one at a time, so the whole 
+    sequence is never in memory. 
+    
+    The result can be cached in a .npy file whose name is keyed by the 
+    image source path and the sampling parameters, so later runs with the 
+    same images and parameters load it instead of calculating it again.
+    If the cache file cannot be written, the background is still returned,
+    without caching it.
+    '''
+    
+    def __init__(self, source, method='median', N_samples=50, 
+                 cache_dir=None, max_block_bytes=2**28):
+        '''
+        source - an image source (image_folder, tiff_image_stack or 
+                 raw_image_stack), or a string with the path of a folder 
+                 of .tif images.
+        method - 'min', 'mean' or 'median'.
+        N_samples - the number of frames sampled from the sequence.
+        cache_dir - the folder in which the background is cached (e.g. the
+                    folder of the results). If None (default) or False, 
+                    the background is not cached; the folder of the 
+                    images is not used by default, since acquisition 
+                    folders are often read-only or shared.
+        max_block_bytes - for the median, the frames are read in blocks of 
+                          rows such that the samples of a block take at
+                          most this number of bytes.
+        '''
+        import os
+        if type(source) == str:
+            source = image_folder(source)
+        
+        if method not in ['min', 'mean', 'median']:
+            raise ValueError("method must be 'min', 'mean' or 'median'.")
+        
+        self.source = source
+        self.method = method
+        self.N_samples = N_samples
+        self.max_block_bytes = max_block_bytes
+        
+        if hasattr(source, 'dir_name'):
+            self.path = os.path.abspath(source.dir_name)
+        else:
+            self.path = os.path.abspath(source.fname)
+        
+        if cache_dir is None:
+            cache_dir = False
+        self.cache_dir = cache_dir
+        
+        
+    def get_sample_frames(self):
+        '''Returns the frame numbers sampled evenly over the sequence.'''
+        from numpy import linspace
+        N = len(self.source)
+        n = min(N, self.N_samples)
+        return unique(linspace(0, N-1, n).astype(int))
+    
+    
+    def get_cache_fname(self):
+        '''Returns the name of the cache file for this background.'''
+        import os
+        from hashlib import md5
+        key = repr((self.path, type(self.source).__name__, 
+                    len(self.source), self.method, self.N_samples))
+        h = md5(key.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, 'background_%s.npy'%h)
+    
+    
+    def get_background(self):
+        '''Returns the background, loading it from the cache if possible, 
+        and otherwise calculating (and caching) it.'''
+        import os
+        from numpy import load, save
+        
+        if self.cache_dir is not False:
+            fname = self.get_cache_fname()
+            if os.path.exists(fname):
+                self.background = load(fname)
+                return self.background
+        
+        self.calculate()
+        
+        if self.cache_dir is not False:
+            try:
+                save(fname, self.background)
+            except OSError as e:
+                print('the background was not cached (%s).'%e)
+        return self.background
+    
+    
+    def calculate(self):
+        '''Calculates the background from the sampled frames.'''
+        frames = self.get_sample_frames()
+        
+        if self.method == 'min':
+            bg = self.source[frames[0]].copy()
+            for i in frames[1:]:
+                minimum(bg, self.source[i], out=bg)
+        
+        elif self.method == 'mean':
+            bg = zeros(self.source[frames[0]].shape)
+            for i in frames:
+                bg += self.source[i]
+            bg = (bg / len(frames)).astype('float32')
+        
+        elif self.method == 'median':
+            from numpy import median
+            im0 = self.source[frames[0]]
+            nrow, ncol = im0.shape
+            row_bytes = len(frames) * ncol * im0.dtype.itemsize
+            block_rows = max(1, self.max_block_bytes // row_bytes)
+            
+            bg = empty((nrow, ncol), dtype='float32')
+            for r0 in range(0, nrow, block_rows):
+                r1 = min(nrow, r0 + block_rows)
+                block = empty((len(frames), r1-r0, ncol), dtype=im0.dtype)
+                for k, i in enumerate(frames):
+                    block[k] = self.source[i][r0:r1]
+                bg[r0:r1] = median(block, axis=0)
+        
+        self.background = bg
+        return bg
+
+
+
+
+def segment_image(im, frame, seg_params, workspaces=None):
+    '''
+    Segments an image and returns its blobs as an array in the blob file 
+    layout (see particle_segmentation.blobs_as_rows), and a dictionary with
+    the number of blobs rejected by each of the size criteria.
+    
+    seg_params - a dictionary with the keyword arguments of the 
+                 particle_segmentation class.
+    
+    workspaces - None, or a dictionary of segmentation_workspace objects 
+                 (by the image shape and dtype) that is reused between 
+                 frames (see get_workspace).
+    '''
+    if workspaces is not None:
+        return get_workspace(workspaces, im, seg_params).segment(im, frame)
+    
+    ps = particle_segmentation(im, **seg_params)
+    ps.get_blobs(size_filter=True)
+    return ps.blobs_as_rows(frame), ps.rejected
+
+
+
+
+# the segmentation parameters and image sources of a worker process in 
+# multi_camera_segmentation
+_worker_seg_params = None
+_worker_source = None
+_worker_workspaces = {}
+
+
+def init_segmentation_worker(seg_params, source):
+    '''Stores the lists of segmentation parameters (including the masks)
+    and image sources, one per camera, in a worker process of the 
+    multi_camera_segmentation pool.'''
+    global _worker_seg_params, _worker_source
+    _worker_seg_params = seg_params
+    _worker_source = source
+    
+    
+def segment_camera_frame_worker(task):
+    '''Segments a (camera, frame) task in a multi_camera_segmentation 
+    worker process. Returns the results of segment_image with the reading 
+    and segmentation times.'''
+    cam, frame = task
+    t0 = perf_counter()
+    im = _worker_source[cam][frame]
+    t1 = perf_counter()
+    res = segment_image(im, frame, _worker_seg_params[cam], 
+                        _worker_workspaces.setdefault(cam, {}))
+    return res, t1 - t0, perf_counter() - t1
+
+
+def ordered_pool_map(pool, func, tasks, window):
+    '''
+    A generator that yields func(task) for the tasks, computed in a pool of
+    processes (an Executor), in the order of the tasks. Unlike pool.map, 
+    which submits all the tasks at once, at most window tasks are submitted
+    ahead of the one whose result is yielded next. So the results are 
+    handed on (e.g. written to a blob file) as they are found, and the 
+    memory held by finished results that wait to be yielded does not grow
+    with the number of tasks.
+    '''
+    from collections import deque
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.submit(func, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def strip_timing(results, timing):
+    '''A generator that yields the segment_image results returned by the
+    worker processes, and adds their reading and segmentation times to the
+    timing dictionary. In the workers, the time spent reading an image is 
+    all spent waiting for it.'''
+    for res, t_read, t_compute in results:
+        timing['read'] += t_read
+        timing['io_wait'] += t_read
+        timing['compute'] += t_compute
+        yield res
+
+
+def segment_timed(images, frames, seg_params, timing, workspaces):
+    '''A generator that segments the images (see segment_image) and yields
+    the results, adding the segmentation time to timing['compute'].'''
+    for im, frame, params, ws in zip(images, frames, seg_params, workspaces):
+        t0 = perf_counter()
+        res = segment_image(im, frame, params, ws)
+        timing['compute'] += perf_counter() - t0
+        yield res
+
+
+
+
+class image_prefetcher(object):
+    '''
+    An iterable that yields read(key) for the keys in order, while the next
+    images are read in a background thread. At most depth images are read 
+    ahead of the image that was last yielded, so the reading and decoding
+    of images overlaps with their segmentation; together with the yielded
+    image, at most depth+1 images are held in memory.
+    
+    The total time spent reading images (in the background thread) is kept
+    in self.read_time, and the time the consumer spent waiting for images 
+    that were not ready yet in self.wait_time.
+    '''
+    
+    def __init__(self, read, keys, depth=2):
+        '''
+        read - a function that returns the image of a key
+        keys - an iterable of the keys to read
+        depth - the number of images read ahead of the yielded image. If 0,
+                each image is read only when it is needed.
+        '''
+        self.read = read
+        self.keys = keys
+        self.depth = depth
+        self.read_time = 0.0
+        self.wait_time = 0.0
+        
+        
+    def timed_read(self, key):
+        t0 = perf_counter()
+        im = self.read(key)
+        return im, perf_counter() - t0
+    
+    
+    def get(self, future):
+        '''Waits for an image read and returns it.'''
+        t0 = perf_counter()
+        im, t_read = future.result()
+        self.wait_time += perf_counter() - t0
+        self.read_time += t_read
+        return im
+    
+    
+    def __iter__(self):
+        if self.depth is None or self.depth < 1:
+            for key in self.keys:
+                im, t_read = self.timed_read(key)
+                self.read_time += t_read
+                self.wait_time += t_read
+                yield im
+            return
+        
+        from concurrent.futures import ThreadPoolExecutor
+        from collections import deque
+        
+        keys = iter(self.keys)
+        queue = deque()
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            for key in keys:
+                queue.append(reader.submit(self.timed_read, key))
+                if len(queue) == self.depth:
+                    break
+            while len(queue) > 0:
+                future = queue.popleft()
+                for key in keys:
+                    queue.append(reader.submit(self.timed_read, key))
+                    break
+                yield self.get(future)
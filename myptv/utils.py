@@ -11,7 +11,7 @@ Utility code to use for the MyPTV package.
 
 
 
-from numpy import dot, array, loadtxt, savetxt
+from numpy import dot, array, loadtxt, savetxt, argmin
 from numpy import append as NPappend
 from numpy.linalg import inv, norm
 
@@ -65,6 +65,106 @@ def line_dist(O1, r1, O2, r2):
 
 
 
+def nearest_point_to_rays(O, r, mask=None):
+    '''
+    A batched triangulation of K groups of up to n lines each. For each 
+    group, this finds the point that minimizes the sum of squared 
+    distances to the lines in the group (a least squares solution), and
+    the RMS of the distances between the point and the lines. Groups with
+    less than n lines are padded, and the padding is marked in the mask.
+    
+    input - 
+    O (array, K x n x 3) - the origins of the lines
+    r (array, K x n x 3) - the direction vectors of the lines
+    mask (array of bool, K x n) - True for the lines that are used; if 
+                                  None, all the lines are used.
+    
+    output - 
+    X (array, K x 3) - the points nearest to the lines in each group
+    rms (array, K) - the RMS of the distances between X and the lines
+    '''
+    from numpy import asarray, ones, eye, einsum, sqrt
+    from numpy.linalg import solve, pinv, LinAlgError
+    
+    O = asarray(O, dtype=float)
+    r = asarray(r, dtype=float)
+    if mask is None:
+        mask = ones(O.shape[:2], dtype=bool)
+    w = mask.astype(float)
+    
+    # the projectors on the planes normal to the lines, (I - r r^T)
+    r = r / sqrt(einsum('kij,kij->ki', r, r))[:,:,None]
+    P = eye(3) - r[:,:,:,None] * r[:,:,None,:]
+    P *= w[:,:,None,None]
+    
+    # the normal equations are sum(P) X = sum(P O)
+    A = P.sum(axis=1)
+    b = einsum('kiab,kib->ka', P, O)
+    try:
+        X = solve(A, b[:,:,None])[:,:,0]
+    except LinAlgError:
+        X = einsum('kab,kb->ka', pinv(A), b)
+    
+    # the distances of X from the lines
+    dX = X[:,None,:] - O
+    d = dX - einsum('kij,kij->ki', dX, r)[:,:,None] * r
+    d2 = einsum('kij,kij->ki', d, d) * w
+    rms = sqrt(d2.sum(axis=1) / w.sum(axis=1))
+    return X, rms
+
+
+
+
+def mean_ray_pair_distance(O, r, mask=None):
+    '''
+    A batched version of the triangulation error used in stereo matching 
+    (see img_system.stereo_match); for K groups of up to n lines each, this 
+    returns the mean over all the pairs of lines in the group of the minimal
+    distance between the two lines of the pair (as in line_dist). Groups 
+    with less than n lines are padded, and the padding is marked in the 
+    mask.
+    
+    input - 
+    O (array, K x n x 3) - the origins of the lines
+    r (array, K x n x 3) - the direction vectors of the lines
+    mask (array of bool, K x n) - True for the lines that are used; if 
+                                  None, all the lines are used.
+    
+    output - 
+    d (array, K) - the mean distance between the pairs of lines
+    '''
+    from numpy import asarray, ones, zeros, cross, einsum, sqrt, where
+    from numpy import errstate
+    
+    O = asarray(O, dtype=float)
+    r = asarray(r, dtype=float)
+    if mask is None:
+        mask = ones(O.shape[:2], dtype=bool)
+    r = r / sqrt(einsum('kij,kij->ki', r, r))[:,:,None]
+    
+    n = O.shape[1]
+    d_sum, n_pairs = zeros(O.shape[0]), zeros(O.shape[0])
+    for i in range(n):
+        for j in range(i+1, n):
+            w = mask[:,i] & mask[:,j]
+            dO = O[:,j] - O[:,i]
+            c = cross(r[:,i], r[:,j])
+            c2 = einsum('ki,ki->k', c, c)
+            
+            # parallel lines are at the distance of a point of one line
+            # from the other line
+            dp = dO - einsum('ki,ki->k', dO, r[:,i])[:,None] * r[:,i]
+            dp = sqrt(einsum('ki,ki->k', dp, dp))
+            with errstate(divide='ignore', invalid='ignore'):
+                ds = abs(einsum('ki,ki->k', dO, c)) / sqrt(c2)
+            d = where(c2 > 1e-24, ds, dp)
+            d_sum += where(w, d, 0.0)
+            n_pairs += w
+    return d_sum / n_pairs
+
+
+
+
 def point_line_dist(O,r,P):
     '''
     for a line (O + a r) and a point P, this returns the distance between
@@ -153,17 +253,19 @@ class match_calibration_blobs_and_points(object):
         The paired points are stored in the attribute self.point_pairs.
         '''
         
-        target_points_eta_zeta = [self.cam.projection(p) for p in self.targets]
-        point_pairs = []
+        # all the target points are projected at once, and the distances 
+        # between every blob and every projected point are calculated in 
+        # one array
+        target_points_eta_zeta = self.cam.projection(self.targets[:,:3])
+        blobs_eta_zeta = self.blobs[:,1::-1]
+        diff = blobs_eta_zeta[:,None,:] - target_points_eta_zeta[None,:,:]
+        dist = norm(diff, axis=2)
+        j_nearest = argmin(dist, axis=1)
         
+        point_pairs = []
         for i in range(len(self.blobs)):
-            j_min = 10000
-            d_min = 1000
-            for j in range(len(target_points_eta_zeta)):
-                d = norm(target_points_eta_zeta[j] - self.blobs[i][1::-1])
-                if d<d_min:
-                    d_min = d
-                    j_min = j
+            j_min = j_nearest[i]
+            d_min = dist[i, j_min]
             
             if d_min < 30:
                 blob_point_pair = NPappend(self.blobs[i][1::-1],
@@ -191,9 +293,8 @@ class match_calibration_blobs_and_points(object):
         import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         
-        for p in self.targets:
-            eta, zeta = self.cam.projection(p)
-            ax.plot(eta, zeta, 'ob')
+        projected = self.cam.projection(self.targets[:,:3])
+        ax.plot(projected[:,0], projected[:,1], 'ob')
             
         ax.plot(self.blobs[:,1], self.blobs[:,0], 'rx') 
         
@@ -31,3 +31,139 @@ def test_calibrate():
     print('mock calibration errors:', O_err, theta_err)
     assert O_err < 1.0 and theta_err < 0.1
 
+
+
+
+def test_mean_squared_err():
+    '''
+    A test that the batched calibration error equals the mean distance 
+    between the projections of the points, done one by one, and the image
+    coordinates.
+    '''
+    cam = camera('cal_test_cam',(1280,1024), './tests/cal_test_files/cal_test_points')
+    cam.load('./tests/cal_test_files')
+    cal = calibrate(cam, cam.lab_points, cam.image_points)
+    
+    D = 0
+    for x, z in zip(cam.lab_points, cam.image_points):
+        p = cam.projection(x)
+        D += ((p[0]-z[0])**2 + (p[1]-z[1])**2)**0.5 / len(cam.lab_points)
+    assert abs(cal.mean_squared_err() - D) < 1e-9
+
+
+
+def test_calibrate_least_squares():
+    '''
+    A test for the coarse calibration of a synthetic camera with the 
+    least squares solver.
+    '''
+    cam = camera('cal_test_cam',(1280,1024), './tests/cal_test_files/cal_test_points')
+    cam.load('./tests/cal_test_files')
+    cal = calibrate(cam, cam.lab_points, cam.image_points)
+    res = cal.searchCalibration(method='least_squares')
+    
+    O = [1.0, 1.0, 500.0]
+    O_err = sum([ (cam.O[i] - O[i])**2 for i in range(3)])**0.5
+    
+    theta = [0.001, 3.1415, 0.001]
+    theta_err = sum([ (cam.theta[i] - theta[i])**2 for i in range(3)])**0.5
+    assert O_err < 1.0 and theta_err < 0.1 and res.njev < 100
+
+
+
+def get_cubic_calibration():
+    '''
+    Returns a calibrate object for a synthetic camera with cubic correction
+    terms; the image coordinates of a grid of points are made with known 
+    coefficients, and the camera's coefficients are then set to zero.
+    '''
+    from numpy import array, linspace, meshgrid
+    cam = camera('cam', (1280,1024))
+    cam.O = array([10.0, 5.0, 500.0])
+    cam.theta = array([0.001, 3.1415, 0.001])
+    cam.f = 2000.0
+    cam.calc_R()
+    cam.set_correction_order(3)
+    E = array([[2e-3, -2e-4, -3e-6, -2e-6, 1e-6, 1e-9, -2e-9, 1e-9, 2e-9],
+               [1e-3, -1e-3, -2e-6, 2e-6, -1e-6, -1e-9, 1e-9, 2e-9, -1e-9]])
+    cam.E[:2,:] = E
+    
+    x, y, z = meshgrid(linspace(-100, 100, 9), linspace(-80, 80, 9), 
+                       [-20.0, 0.0, 20.0])
+    lab = array([x.ravel(), y.ravel(), z.ravel()]).T
+    img = cam.projection(lab)
+    
+    cam.E[:] = 0.0
+    cal = calibrate(cam, lab, img)
+    return cal
+
+
+
+def test_linear_correction_calibration():
+    '''
+    A test for the closed form calibration of the correction terms. The
+    image coordinates of synthetic points are made with known quadratic 
+    and cubic correction terms, which are then found again.
+    '''
+    cal = get_cubic_calibration()
+    cal.fineCalibration(method='linear')
+    assert cal.mean_squared_err() < 1e-3
+
+
+
+def test_cubic_least_squares_calibration():
+    '''
+    A test for the least squares calibration of cubic correction terms; 
+    the finite difference steps are scaled to the size of each term, so
+    it converges in a few iterations.
+    '''
+    cal = get_cubic_calibration()
+    res = cal.fineCalibration(method='least_squares', maxiter=500)
+    assert res.njev < 30 and cal.mean_squared_err() < 1e-3
+
+
+
+def test_bundle_adjustment():
+    '''
+    A test for the joint calibration of three synthetic cameras, using 
+    calibration points and matched particles; the cameras start with 
+    perturbed parameters, and the true ones are found again. Particles 
+    without calibration points leave the solution undetermined, which 
+    raises an error.
+    '''
+    from numpy import array, linspace, meshgrid
+    from myptv.imaging_mod import img_system
+    from myptv.calibrate_mod import bundle_adjustment
+    cams = []
+    for i in [1,2,3]:
+        cam = camera('matching_test_cam%d'%i, (1280,1024))
+        cam.load('./tests/matching_test_files/')
+        cams.append(cam)
+    true_O = [cam.O.copy() for cam in cams]
+    
+    x, y, z = meshgrid(linspace(-15, 15, 4), linspace(-15, 15, 4), 
+                       [-10.0, 10.0])
+    lab = array([x.ravel(), y.ravel(), z.ravel()]).T
+    cal_points = [(lab, cam.projection(lab)) for cam in cams]
+    particles = [[px, py, pz, 
+                  [(c, (k, tuple(cams[c].projection([px, py, pz])))) 
+                   for c in range(3)], 0.0] 
+                 for k, (px, py, pz) in enumerate(lab[::3] + 1.0)]
+    
+    for cam in cams:
+        cam.O = cam.O + array([1.0, -1.0, 2.0])
+        cam.theta = cam.theta + 0.005
+        cam.calc_R()
+    
+    try:
+        bundle_adjustment(img_system(cams), None, particles)
+        test_gauge = False
+    except ValueError:
+        test_gauge = True
+    
+    ba = bundle_adjustment(img_system(cams), cal_points, particles)
+    res = ba.solve()
+    O_err = max([sum((cam.O - O)**2)**0.5 for cam, O in zip(cams, true_O)])
+    res.x[:] = 0.0
+    test_copied = all([(cam.O != 0).any() for cam in cams])
+    assert O_err < 1e-3 and res.success and test_gauge and test_copied
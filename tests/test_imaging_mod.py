@@ -60,3 +60,109 @@ def test_imaging():
     a, b, c = round(res[0][0], 10), round(res[0][1], 10), round(res[0][2], 10)
     assert a == 0.1 and b == 0.1, c == 0.1
 
+
+
+def test_batched_get_r():
+    '''
+    A test that the direction vectors of an array of points are exactly the
+    same as those of the points given one by one, for a camera with a 
+    non-linear correction term.
+    '''
+    from numpy import linspace
+    cam = imaging_mod.camera('1', (1000.,1000.))
+    cam.O = array([400.0 , 10.0, 300.0])
+    cam.theta = array([0.8, -0.4, 0.1])
+    cam.f = 4000
+    cam.xh, cam.yh = 1.0, -1.0
+    cam.calc_R()
+    cam.E[0,:] = [1e-3, -2e-3, 1e-6, 2e-6, -1e-6]
+    cam.E[1,:] = [-1e-3, 3e-3, -2e-6, 1e-6, 3e-6]
+    
+    eta, zeta = linspace(0, 1000, 37), linspace(1000, 20, 37)
+    r = cam.get_r(eta, zeta)
+    r_single = array([cam.get_r(eta[i], zeta[i]) for i in range(len(eta))])
+    
+    test_shape = r.shape == (37, 3)
+    test_same = (r == r_single).all()
+    assert test_shape and test_same
+
+
+def test_batched_projection():
+    '''
+    A test that projecting an array of points gives the same image 
+    coordinates as projecting the points one by one, and that the rays of
+    the projected points pass through the points.
+    '''
+    from numpy import linspace, column_stack, cross
+    from numpy.linalg import norm
+    cam = imaging_mod.camera('1', (1000.,1000.))
+    cam.O = array([400.0 , 10.0, 300.0])
+    cam.theta = array([0.8, -0.4, 0.1])
+    cam.f = 4000
+    cam.calc_R()
+    cam.E[0,:] = [1e-3, -2e-3, 1e-7, 2e-7, -1e-7]
+    cam.E[1,:] = [-1e-3, 3e-3, -2e-7, 1e-7, 3e-7]
+    
+    X = column_stack([linspace(-5, 5, 11), linspace(0, 3, 11), 
+                      linspace(-2, 2, 11)])
+    proj = cam.projection(X)
+    proj_single = array([cam.projection(x) for x in X])
+    
+    r = cam.get_r(proj[:,0], proj[:,1])
+    dist = norm(cross(X - cam.O, r), axis=1)
+    
+    test_shape = proj.shape == (11, 2)
+    test_same = (abs(proj - proj_single) < 1e-9).all()
+    test_rays = (dist < 1e-3).all()
+    assert test_shape and test_same and test_rays
+
+
+
+def test_cameras_file(tmp_path):
+    '''
+    A test for saving cameras in a single .npz file; the loaded cameras 
+    have the same parameters, an img_system loaded twice from the same file
+    shares the cameras, a changed file is read again and replaces the old
+    version in the cache, and a camera loaded from a file with several 
+    cameras gets its own parameters.
+    '''
+    import os
+    fname = os.path.join(str(tmp_path), 'cameras.npz')
+    cams = []
+    for i in range(2):
+        cam = imaging_mod.camera('cam%d'%i, (1280.,1024.))
+        cam.O = array([400.0*i , 10.0, 300.0])
+        cam.theta = array([0.8, -0.4*i, 0.1])
+        cam.f = 4000 + i
+        cam.xh, cam.yh = 5.0, -3.0
+        cam.E[0,:] = [1e-3, -2e-3, 1e-7, 2e-7, -1e-7]
+        cam.calc_R()
+        cams.append(cam)
+    imaging_mod.img_system(cams).save(fname)
+    
+    imsys1 = imaging_mod.img_system(fname)
+    imsys2 = imaging_mod.img_system(fname)
+    test_same = all([c1.get_parameters_hash() == c2.get_parameters_hash() 
+                     for c1, c2 in zip(cams, imsys1.cameras)])
+    test_names = [c.name for c in imsys1.cameras] == ['cam0', 'cam1']
+    test_shared = imsys1.cameras[1] is imsys2.cameras[1]
+    
+    cams[1].f = 5000.0
+    imaging_mod.img_system(cams).save(fname)
+    os.utime(fname, ns=(0, os.stat(fname).st_mtime_ns + 10**9))
+    test_reloaded = imaging_mod.img_system(fname).cameras[1].f == 5000.0
+    test_cache = len([k for k in imaging_mod._cameras_cache 
+                      if k == os.path.abspath(fname)]) == 1
+    
+    imaging_mod.img_system(cams).save(os.path.join(str(tmp_path), 'cam1.npz'))
+    imaging_mod.img_system(cams).save(os.path.join(str(tmp_path), 'cam7.npz'))
+    cam = imaging_mod.camera('cam1', (1280.,1024.))
+    cam.load(str(tmp_path))
+    test_by_name = cam.f == 5000.0
+    try:
+        imaging_mod.camera('cam7', (1280.,1024.)).load(str(tmp_path))
+        test_missing = False
+    except ValueError:
+        test_missing = True
+    assert test_same and test_names and test_shared and test_reloaded
+    assert test_cache and test_by_name and test_missing
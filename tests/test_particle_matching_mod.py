@@ -55,3 +55,131 @@ def test_matching():
     assert test_p1 and test_n_found
 
 
+
+
+
+def test_nearest_point_to_rays():
+    '''
+    A test for the batched triangulation; groups of rays that cross at a 
+    point give back the point with zero error, two skewed rays give their
+    midpoint with half their distance as the RMS error, and padded rays 
+    are ignored.
+    '''
+    from numpy import array
+    from myptv.utils import nearest_point_to_rays, line_dist
+    P = array([1.0, -2.0, 3.0])
+    O = array([[[10.0, 0, 0], [0, 10.0, 0], [0, 0, 10.0]],
+               [[0, 0, 0], [5.0, 0, 1.0], [7.0, 7.0, 7.0]]])
+    r = array([P - O[0], [[1.0, 0, 0], [0, 1.0, 0], [1.0, 1.0, 1.0]]])
+    mask = array([[True, True, True], [True, True, False]])
+    X, rms = nearest_point_to_rays(O, r, mask)
+    
+    D, x = line_dist(O[1,0], r[1,0], O[1,1], r[1,1])
+    test_crossing = sum((X[0]-P)**2)**0.5 < 1e-9 and rms[0] < 1e-9
+    test_skewed = sum((X[1]-x)**2)**0.5 < 1e-9 and abs(rms[1]-D/2) < 1e-9
+    assert test_crossing and test_skewed
+
+
+
+
+def test_mean_ray_pair_distance():
+    '''
+    A test for the batched triangulation error; it is the mean distance 
+    between the pairs of rays in a group, as in img_system.stereo_match,
+    and padded rays are ignored.
+    '''
+    from numpy import array
+    from myptv.utils import mean_ray_pair_distance, line_dist
+    O = array([[[0, 0, 0], [5.0, 0, 1.0], [7.0, 7.0, 7.0]],
+               [[0, 0, 0], [5.0, 0, 1.0], [7.0, 7.0, 7.0]]])
+    r = array([[[1.0, 0, 0], [0, 1.0, 0], [1.0, 1.0, -1.0]],
+               [[1.0, 0, 0], [0, 1.0, 0], [1.0, 1.0, -1.0]]])
+    mask = array([[True, True, True], [True, True, False]])
+    d = mean_ray_pair_distance(O, r, mask)
+    
+    D = [line_dist(O[0,i], r[0,i], O[0,j], r[0,j])[0] 
+         for i, j in [(0,1), (0,2), (1,2)]]
+    test_three = abs(d[0] - sum(D)/3) < 1e-9
+    test_masked = abs(d[1] - D[0]) < 1e-9
+    assert test_three and test_masked
+
+
+
+def test_epipolar_matching():
+    '''
+    A test for the matching with epipolar bands. We project synthetic 
+    particles onto three cameras, and check that the candidate pairs 
+    include the true pairs and that all the particles are matched.
+    '''
+    from numpy import array
+    from myptv.imaging_mod import epipolar_pair
+    from myptv.particle_matching_mod import matching
+    cams = []
+    for i in [1,2,3]:
+        cam = camera('matching_test_cam%d'%i, (1280,1024))
+        cam.load('./tests/matching_test_files/')
+        cams.append(cam)
+    imsys = img_system(cams)
+    
+    X = array([[0.0, 0.0, 0.0], [5.0, -3.0, 2.0], [-8.0, 6.0, -4.0], 
+               [12.0, 10.0, 7.0], [-15.0, -12.0, 9.0]])
+    pd = dict([(cam.name, cam.projection(X).tolist()) for cam in cams])
+    ROI = ((-20, 20), (-20, 20), (-20, 20))
+    
+    ep = epipolar_pair(cams[0], cams[1], ROI)
+    xy1 = array(pd[cams[0].name])
+    r1 = cams[0].get_r(xy1[:,0], xy1[:,1])
+    i1, i2 = ep.get_candidates(r1, pd[cams[1].name], 0.5)
+    pairs = set(zip(i1.tolist(), i2.tolist()))
+    test_pairs = all([(k, k) in pairs for k in range(len(X))])
+    
+    M = matching(imsys, pd, ROI, 40.0, max_err=0.1, epipolar_band=0.5)
+    M.get_voxel_dictionary()
+    M.list_candidates()
+    M.get_particles()
+    found = sorted([p[:3] for p in M.matched_particles])
+    test_found = len(found) == len(X) and all(
+        [min([sum((array(p) - x)**2)**0.5 for p in found]) < 1e-3 for x in X])
+    assert test_pairs and test_found
+
+
+
+def test_epipolar_matching_parallel_cameras():
+    '''
+    A test for the matching with epipolar bands when the cameras are 
+    parallel, so their epipoles are at infinity; the epipolar lines are 
+    then parallel, and the true pairs should still be found.
+    '''
+    from numpy import array, pi
+    from myptv.imaging_mod import epipolar_pair
+    from myptv.particle_matching_mod import matching
+    cams = []
+    for i, O in enumerate([[0, 0, 500], [100, 0, 500], [50, 80, 500]]):
+        cam = camera('parallel_cam%d'%i, (1280,1024))
+        cam.O = array(O, dtype=float)
+        cam.theta = array([0.0, pi, 0.0])
+        cam.f = 2000.0
+        cam.calc_R()
+        cams.append(cam)
+    imsys = img_system(cams)
+    
+    X = array([[0.0, 0.0, 0.0], [5.0, -3.0, 2.0], [-8.0, 6.0, -4.0], 
+               [12.0, 10.0, 7.0], [-15.0, -12.0, 9.0]])
+    pd = dict([(cam.name, cam.projection(X).tolist()) for cam in cams])
+    ROI = ((-20, 20), (-20, 20), (-20, 20))
+    
+    ep = epipolar_pair(cams[0], cams[1], ROI)
+    xy1 = array(pd[cams[0].name])
+    r1 = cams[0].get_r(xy1[:,0], xy1[:,1])
+    i1, i2 = ep.get_candidates(r1, pd[cams[1].name], 0.5)
+    pairs = set(zip(i1.tolist(), i2.tolist()))
+    test_pairs = ep.parallel and all([(k, k) in pairs for k in range(len(X))])
+    
+    M = matching(imsys, pd, ROI, 40.0, max_err=0.1, epipolar_band=0.5)
+    M.get_voxel_dictionary()
+    M.list_candidates()
+    M.get_particles()
+    found = sorted([p[:3] for p in M.matched_particles])
+    test_found = len(found) == len(X) and all(
+        [min([sum((array(p) - x)**2)**0.5 for p in found]) < 1e-3 for x in X])
+    assert test_pairs and test_found
@@ -27,3 +27,432 @@ def test_segmentation():
     assert test_blob_number
 
 
+
+
+def test_blob_labeling():
+    '''
+    A test that the vectorized blob labeling gives the same blobs as the 
+    legacy pure Python labeling on the segmentation test image.
+    '''
+    from myptv.segmentation_mod import particle_segmentation
+    from skimage.io import imread
+    
+    im = imread('./tests/segmentation_test_files/im_001.tif') * 1.0
+    
+    blobs = []
+    for labeling in ['vectorized', 'legacy']:
+        ps = particle_segmentation(im, threshold=50, sigma=1.0, 
+                                   labeling=labeling)
+        ps.get_blobs()
+        blobs.append(ps.blobs)
+    
+    test_blob_number = len(blobs[0])==len(blobs[1])
+    test_blobs = (blobs[0]==blobs[1]).all()
+    assert test_blob_number and test_blobs
+
+
+def test_parallel_segmentation():
+    '''
+    A test that segmenting the images with a pool of workers gives the same
+    blobs as the serial loop segmentation.
+    '''
+    dirname = './tests/segmentation_test_files'
+    
+    blobs = []
+    for n_workers in [1, 2]:
+        segmentation = loop_segmentation(dirname, threshold=50, sigma=1.0,
+                                         n_workers=n_workers)
+        segmentation.segment_folder_images()
+        blobs.append(segmentation.blobs)
+    
+    assert (blobs[0]==blobs[1]).all()
+
+
+def test_streaming_segmentation(tmp_path):
+    '''
+    A test that streaming the blobs to a file frame by frame gives the same
+    blob file as saving the results at the end, and that a frame can be
+    read back using the frame index file.
+    '''
+    from myptv.segmentation_mod import read_blob_file_frame
+    dirname = './tests/segmentation_test_files'
+    fname_saved = str(tmp_path / 'blobs_saved')
+    fname_streamed = str(tmp_path / 'blobs_streamed')
+    
+    segmentation = loop_segmentation(dirname, threshold=50, sigma=1.0)
+    segmentation.segment_folder_images()
+    segmentation.save_results(fname_saved)
+    blobs = segmentation.blobs
+    
+    segmentation.segment_folder_images(stream_fname=fname_streamed)
+    
+    with open(fname_saved) as f1, open(fname_streamed) as f2:
+        test_same_file = f1.read() == f2.read()
+    
+    frame_blobs = read_blob_file_frame(fname_streamed, 0)
+    test_frame = (frame_blobs == blobs[blobs[:,-1]==0]).all()
+    assert test_same_file and test_frame
+
+
+def test_image_stack_segmentation(tmp_path):
+    '''
+    A test that segmenting frames from a memory-mapped raw image stack gives
+    the same blobs as segmenting the image files of a folder.
+    '''
+    from myptv.segmentation_mod import raw_image_stack
+    from skimage.io import imread
+    dirname = './tests/segmentation_test_files'
+    im = imread(dirname + '/im_001.tif')
+    
+    fname = str(tmp_path / 'stack.raw')
+    with open(fname, 'wb') as f:
+        f.write(b'header')
+        f.write(im.tobytes())
+        f.write(im.tobytes())
+    stack = raw_image_stack(fname, im.shape, dtype=im.dtype, offset=6)
+    
+    segmentation = loop_segmentation(dirname, threshold=50, sigma=1.0)
+    segmentation.segment_folder_images()
+    blobs_folder = segmentation.blobs
+    
+    segmentation = loop_segmentation(stack, threshold=50, sigma=1.0)
+    segmentation.segment_folder_images()
+    blobs_stack = segmentation.blobs
+    
+    test_n_frames = len(stack)==2
+    test_blobs = (blobs_stack[blobs_stack[:,-1]==0] == blobs_folder).all()
+    assert test_n_frames and test_blobs
+
+
+def test_temporal_background(tmp_path):
+    '''
+    A test for the static background: the per-pixel minimum background of
+    a stack is calculated, cached only in a folder that is given, and used
+    in the segmentation; a cache that cannot be written is skipped.
+    '''
+    from myptv.segmentation_mod import raw_image_stack, temporal_background
+    from skimage.io import imread
+    import os
+    dirname = './tests/segmentation_test_files'
+    im = imread(dirname + '/im_001.tif')
+    
+    fname = str(tmp_path / 'stack.raw')
+    with open(fname, 'wb') as f:
+        f.write(im.tobytes())
+        f.write((im*0 + 5).tobytes())
+    stack = raw_image_stack(fname, im.shape, dtype=im.dtype)
+    
+    tb = temporal_background(stack, method='min', N_samples=2)
+    background = tb.get_background()
+    test_background = (background == 5).all()
+    test_not_cached = os.listdir(str(tmp_path)) == ['stack.raw']
+    
+    cache_dir = str(tmp_path / 'cache')
+    os.mkdir(cache_dir)
+    tb = temporal_background(stack, method='min', N_samples=2, 
+                             cache_dir=cache_dir)
+    tb.get_background()
+    test_cached = os.path.exists(tb.get_cache_fname())
+    
+    tb = temporal_background(stack, method='min', N_samples=2, 
+                             cache_dir=str(tmp_path / 'missing'))
+    test_failed_cache = (tb.get_background() == 5).all()
+    
+    segmentation = loop_segmentation(stack, threshold=45, sigma=1.0,
+                                     background=background, N_img=1)
+    segmentation.segment_folder_images()
+    test_blob_number = len(segmentation.blobs)==8
+    assert test_background and test_not_cached and test_cached
+    assert test_failed_cache and test_blob_number
+
+
+def test_ROI_segmentation():
+    '''
+    A test that segmenting an image cropped to an ROI gives the same blobs
+    as segmenting the full image with an ROI mask.
+    '''
+    from myptv.segmentation_mod import particle_segmentation
+    from skimage.io import imread
+    from numpy import zeros
+    
+    im = imread('./tests/segmentation_test_files/im_001.tif')
+    ROI = [10, im.shape[1]//2, 5, im.shape[0]-20]
+    mask = zeros(im.shape)
+    mask[ROI[2]:ROI[3]+1, ROI[0]:ROI[1]+1] = 1
+    
+    ps_mask = particle_segmentation(im, threshold=50, sigma=1.0, mask=mask)
+    ps_mask.get_blobs()
+    
+    ps_ROI = particle_segmentation(im, threshold=50, sigma=1.0, ROI=ROI)
+    ps_ROI.get_blobs()
+    
+    test_blob_number = len(ps_ROI.blobs) == len(ps_mask.blobs)
+    test_blobs = (ps_ROI.blobs == ps_mask.blobs).all()
+    assert test_blob_number and test_blobs
+
+
+def test_tiled_segmentation():
+    '''
+    A test that segmenting an image in tiles, over several threads, gives
+    the same blobs as segmenting the whole image.
+    '''
+    from myptv.segmentation_mod import particle_segmentation
+    from skimage.io import imread
+    
+    im = imread('./tests/segmentation_test_files/im_001.tif')
+    
+    ps = particle_segmentation(im, threshold=50, sigma=1.0, local_filter=9)
+    ps.get_blobs()
+    
+    ps_tiled = particle_segmentation(im, threshold=50, sigma=1.0, 
+                                     local_filter=9, tile_size=17, 
+                                     n_threads=2)
+    ps_tiled.get_blobs()
+    
+    test_blob_number = len(ps_tiled.blobs) == len(ps.blobs)
+    test_blobs = (ps_tiled.blobs == ps.blobs).all()
+    assert test_blob_number and test_blobs
+
+
+def test_blobs_size_filter():
+    '''
+    A test that the size filter applies all the criteria (including the
+    area), that filtering during the blob statistics gives the same blobs
+    as filtering afterwards, and that the rejected blobs are counted.
+    '''
+    from myptv.segmentation_mod import particle_segmentation
+    from skimage.io import imread
+    
+    im = imread('./tests/segmentation_test_files/im_001.tif')
+    kwargs = dict(threshold=50, sigma=1.0, min_xsize=1, max_area=5)
+    
+    ps = particle_segmentation(im, **kwargs)
+    ps.get_blobs()
+    N_all = len(ps.blobs)
+    ps.apply_blobs_size_filter()
+    
+    ps_during = particle_segmentation(im, **kwargs)
+    ps_during.get_blobs(size_filter=True)
+    
+    test_area = (ps.blobs['area'] < 5).all()
+    test_xsize = (ps.blobs['size_x'] > 1).all()
+    test_same = (ps.blobs == ps_during.blobs).all()
+    test_rejected = ps.rejected == ps_during.rejected
+    test_count = ps.rejected['max_area'] > 0 and \
+                 N_all - len(ps.blobs) <= sum(ps.rejected.values())
+    assert test_area and test_xsize and test_same and test_rejected and \
+           test_count
+
+
+def test_multi_camera_segmentation(tmp_path):
+    '''
+    A test that segmenting several cameras in one pass over a shared pool
+    gives the same blobs for each camera as segmenting it on its own.
+    '''
+    from myptv.segmentation_mod import multi_camera_segmentation
+    from numpy import loadtxt
+    dirname = './tests/segmentation_test_files'
+    fname = str(tmp_path / 'blobs_cam1')
+    
+    thresholds = [50, 30]
+    single = []
+    for th in thresholds:
+        segmentation = loop_segmentation(dirname, threshold=th, sigma=1.0)
+        segmentation.segment_folder_images()
+        single.append(segmentation.blobs)
+    
+    tests = []
+    for n_workers in [1, 2]:
+        segs = [loop_segmentation(dirname, threshold=th, sigma=1.0)
+                for th in thresholds]
+        multi = multi_camera_segmentation(segs, save_names=[fname, None],
+                                          n_workers=n_workers)
+        multi.segment_images()
+        blobs_cam1 = loadtxt(fname).reshape(-1, 6)
+        tests.append(len(blobs_cam1) == len(single[0]))
+        tests.append((abs(blobs_cam1 - single[0]) < 1e-6).all())
+        tests.append((segs[1].blobs == single[1]).all())
+        tests.append(segs[1].N_blobs == len(single[1]))
+    assert all(tests)
+
+
+def test_image_prefetcher():
+    '''
+    A test that the prefetcher yields the images in order for any queue 
+    depth, that the next image is read while the yielded one is processed,
+    and that no more than depth images are read ahead of it.
+    '''
+    from myptv.segmentation_mod import image_prefetcher
+    from threading import Event
+    
+    tests = []
+    for depth in [0, 1, 3]:
+        started = []
+        second_read = Event()
+        def read(i):
+            started.append(i)
+            if i == 1:
+                second_read.set()
+            return i
+        
+        prefetcher = image_prefetcher(read, range(6), depth=depth)
+        items = []
+        for item in prefetcher:
+            if item == 0 and depth > 0:
+                tests.append(second_read.wait(10.0))
+            tests.append(len(started) <= item + 1 + depth)
+            items.append(item)
+        tests.append(items == list(range(6)) and started == list(range(6)))
+        
+        if depth == 0:
+            tests.append(prefetcher.wait_time >= prefetcher.read_time)
+    
+    # the loop segmentation gives the same blobs with and without prefetch
+    dirname = './tests/segmentation_test_files'
+    blobs = []
+    for prefetch in [0, 2]:
+        segmentation = loop_segmentation(dirname, threshold=50, sigma=1.0,
+                                         prefetch=prefetch)
+        segmentation.segment_folder_images()
+        blobs.append(segmentation.blobs)
+    tests.append((blobs[0] == blobs[1]).all())
+    tests.append(segmentation.timing['total'] >= 
+                 segmentation.timing['compute'])
+    assert all(tests)
+
+
+def test_segmentation_buffers():
+    '''
+    A test that reusing the work buffers between frames, and segmenting
+    in float64, give the same blobs as the default float32 segmentation, 
+    and that the binary and label images are boolean and int32.
+    '''
+    from myptv.segmentation_mod import particle_segmentation
+    from skimage.io import imread
+    
+    im = imread('./tests/segmentation_test_files/im_001.tif')
+    ps = particle_segmentation(im, threshold=50, sigma=1.0)
+    ps.get_blobs()
+    
+    tests = [ps.bin_im.dtype == bool, ps.labeled.dtype == 'int32']
+    
+    buffers = {}
+    for i in range(2):
+        ps_buf = particle_segmentation(im, threshold=50, sigma=1.0, 
+                                       buffers=buffers)
+        ps_buf.get_blobs()
+        tests.append((ps_buf.blobs == ps.blobs).all())
+    tests.append(ps_buf.bin_im is buffers['binary'])
+    
+    ps64 = particle_segmentation(im, threshold=50, sigma=1.0, 
+                                 precision='float64')
+    ps64.get_blobs()
+    tests.append((ps64.blobs == ps.blobs).all())
+    assert all(tests)
+
+
+def test_segmentation_workspace():
+    '''
+    A test that a segmentation workspace gives the same blobs as a fresh 
+    segmentation, fills the same work arrays for every frame, writes the
+    blobs into a given output array, and rejects frames of another shape.
+    '''
+    from myptv.segmentation_mod import segmentation_workspace, segment_image
+    from skimage.io import imread
+    from numpy import zeros
+    
+    im = imread('./tests/segmentation_test_files/im_001.tif')
+    seg_params = dict(threshold=50, sigma=1.0)
+    rows, rejected = segment_image(im, 3, seg_params)
+    
+    workspace = segmentation_workspace(im.shape, im.dtype, **seg_params)
+    arrays = [id(buf) for buf in workspace.buffers.values()]
+    
+    out = zeros((100, 6))
+    tests = []
+    for i in range(2):
+        rows_ws, rejected_ws = workspace.segment(im, frame=3, out=out)
+        tests.append((rows_ws == rows).all())
+        tests.append(rejected_ws == rejected)
+    tests.append(rows_ws.base is out)
+    tests.append([id(buf) for buf in workspace.buffers.values()] == arrays)
+    
+    try:
+        workspace.segment(im[1:])
+        tests.append(False)
+    except ValueError:
+        tests.append(True)
+    assert all(tests)
+
+
+def test_resume_segmentation(tmp_path):
+    '''
+    A test that a segmentation run that was interrupted (leaving a partly
+    written frame) and then resumed, gives the same blob file and frame 
+    index as an uninterrupted run.
+    '''
+    from myptv.segmentation_mod import raw_image_stack
+    from skimage.io import imread
+    from numpy import roll
+    im = imread('./tests/segmentation_test_files/im_001.tif')
+    
+    fname = str(tmp_path / 'stack.raw')
+    with open(fname, 'wb') as f:
+        for i in range(4):
+            f.write(roll(im, 7*i, axis=1).tobytes())
+    stack = raw_image_stack(fname, im.shape, dtype=im.dtype)
+    
+    fname_full = str(tmp_path / 'blobs_full')
+    segmentation = loop_segmentation(stack, threshold=50, sigma=1.0)
+    segmentation.segment_folder_images(stream_fname=fname_full)
+    
+    # a run that stopped after 2 frames, in the middle of the third frame
+    fname_resumed = str(tmp_path / 'blobs_resumed')
+    segmentation = loop_segmentation(stack, threshold=50, sigma=1.0, 
+                                     N_img=2)
+    segmentation.segment_folder_images(stream_fname=fname_resumed)
+    with open(fname_resumed, 'a') as f:
+        f.write('12.34\t56.')
+    with open(fname_resumed + '.idx', 'a') as f:
+        f.write('2\t15')
+    
+    segmentation = loop_segmentation(stack, threshold=50, sigma=1.0)
+    segmentation.segment_folder_images(stream_fname=fname_resumed, 
+                                       resume=True)
+    
+    tests = [len(segmentation.rejected['min_area']) == 2]
+    for ext in ['', '.idx']:
+        with open(fname_full + ext) as f1, open(fname_resumed + ext) as f2:
+            tests.append(f1.read() == f2.read())
+    assert all(tests)
+
+
+
+def test_ordered_pool_map(tmp_path):
+    '''
+    A test that the frames segmented in a pool are written to the blob 
+    file as they are found, in order, while only a bounded number of the
+    next frames have been submitted to the pool.
+    '''
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from numpy import zeros
+    from myptv.segmentation_mod import ordered_pool_map, blob_file_writer
+    from myptv.segmentation_mod import read_blob_file_index
+    
+    submitted = []
+    def func(frame):
+        submitted.append(frame)
+        return zeros((1, 6)) + frame
+    
+    fname = os.path.join(str(tmp_path), 'blobs')
+    writer = blob_file_writer(fname)
+    window, tests = 4, []
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for i, blobs in enumerate(ordered_pool_map(pool, func, range(50), 
+                                                   window)):
+            tests.append(blobs[0,0] == i and len(submitted) <= i + window)
+            writer.write_frame(i, blobs)
+            tests.append(len(read_blob_file_index(fname)) == i + 1)
+    writer.close()
+    assert all(tests) and len(tests) == 100